@@ -0,0 +1,84 @@
+"""A cache of parse results, in memory and optionally on disk."""
+import sqlite3
+from collections import OrderedDict
+
+
+# stands in for the words of a cached tree, which are filled in per sentence
+LEAF = '\x1f'
+
+
+class ParseCache:
+    """Results keyed on a namespace and the word ids of a sentence.
+
+    The namespace identifies the grammar and the settings that the result
+    depends on, see Parser.cache_namespace. The most recently used results
+    are kept in memory, at most size of them. With path, all results are
+    also stored in an sqlite database, which is shared by all the processes
+    and runs that use the same path.
+
+    A result is a (tree, score) pair, where tree is a bracket string with
+    LEAF for each word, see fill_leaves, or None for a perplexity.
+    """
+
+    def __init__(self, path=None, size=100000):
+        self.path = path
+        self.size = size
+        self._memory = OrderedDict()
+        self._db = None  # opened on first use, so that each process opens its own
+
+    def get(self, namespace, sentence_array):
+        key = namespace, sentence_array.tobytes()
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            return self._memory[key]
+        if self.path is None:
+            return None
+        row = self.db.execute(
+            'SELECT tree, score FROM results WHERE namespace = ? AND sentence = ?', key).fetchone()
+        if row is not None:
+            self._remember(key, row)
+        return row
+
+    def put(self, namespace, sentence_array, tree, score):
+        key = namespace, sentence_array.tobytes()
+        self._remember(key, (tree, score))
+        if self.path is not None:
+            with self.db:
+                self.db.execute(
+                    'INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)', key + (tree, score))
+
+    @property
+    def db(self):
+        if self._db is None:
+            self._db = sqlite3.connect(self.path, timeout=60)
+            self._db.execute('PRAGMA journal_mode=WAL')  # readers do not block the writer
+            self._db.execute('PRAGMA synchronous=NORMAL')
+            with self._db:
+                self._db.execute(
+                    'CREATE TABLE IF NOT EXISTS results ('
+                    'namespace TEXT, sentence BLOB, tree TEXT, score REAL, '
+                    'PRIMARY KEY (namespace, sentence))')
+        return self._db
+
+    def _remember(self, key, result):
+        self._memory[key] = tuple(result)
+        self._memory.move_to_end(key)
+        if len(self._memory) > self.size:
+            self._memory.popitem(last=False)
+
+    def __getstate__(self):
+        # a worker process starts with an empty memory and its own connection
+        return self.path, self.size
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+
+def fill_leaves(tree, sentence):
+    """Put the words of sentence in place of the LEAF of a cached tree."""
+    parts = tree.split(LEAF)
+    assert len(parts) == len(sentence) + 1
+    pieces = [parts[0]]
+    for word, part in zip(sentence, parts[1:]):
+        pieces.extend((word, part))
+    return ''.join(pieces)
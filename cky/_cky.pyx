@@ -1,153 +1,508 @@
 #cython: language_level=3, boundscheck=False, wraparound=False
 import cython
+from cython.parallel cimport prange
 import numpy as np
 cimport numpy as np
 from libc.math cimport log, exp
+from libc.stdlib cimport malloc, free, qsort
 from numpy.math cimport INFINITY
 
+# The charts are triangular: score[A][c] is the score of nonterminal A in cell c,
+# with the cells ordered by span length and then by begin, see cky/chart.py.
+
+
+cdef enum Semiring:
+    VITERBI  # max, with backpointers
+    INSIDE  # log-sum, without backpointers
+
 
 def cky(
         int[:] sentence,
         int sent_len,
-        float[:,:,:] score,
-        int[:,:,:,:] back,
-        int num_lex_rules,
+        float[:,:] score,
+        int[:,:] back_rule,
+        short[:,:] back_split,
+        int[:,:] live,
+        float[:,:] live_score,
+        int[:] num_live,
+        float[:,:] lexical,
         int num_unary_rules,
         int num_binary_rules,
         int[:,:] lex_rules,
         int[:,:] unary_rules,
         int[:,:] binary_rules,
         int[:,:] top_rules,
-        float[:] lex_prob,
-        float[:] unary_prob,
-        float[:] binary_prob,
-        float[:] top_prob
+        int[:] lex_offsets,
+        int[:] binary_offsets,
+        float[:] lex_logprob,
+        float[:] unary_logprob,
+        float[:] binary_logprob,
+        float[:] top_logprob,
+        int num_threads=1,
+        int beam=0,
+        float threshold=0,
+        unsigned char[:,:] allowed=None,
+        int[:] projection=None
     ):
+    """Viterbi chart and backpointers, and the number of pruned items, see fill_chart.
+
+    The backpointer of item A in cell c is the rule in back_rule[A][c] and the split in
+    back_split[A][c]: a split of -1 is a lexical rule (and the rule is not set), -2 is
+    the unary rule back_rule, -3 the top rule back_rule, and any other split the binary
+    rule back_rule.
+
+    The other buffers are only used while the chart is filled: per cell, live holds the
+    nonterminals with a finite score, live_score their packed scores and num_live their
+    number, and lexical holds the lexical scores of the tags, see parser.ChartArena.
+    """
+
+    cdef int num_pruned
+
+    with nogil:
+        num_pruned = fill_chart(
+            VITERBI, sentence, sent_len, score, back_rule, back_split, live, live_score, num_live, lexical,
+            num_unary_rules, lex_rules, unary_rules, binary_rules, top_rules,
+            lex_offsets, binary_offsets, lex_logprob, unary_logprob, binary_logprob, top_logprob,
+            num_threads, beam, threshold, allowed, projection)
+
+    return score, back_rule, back_split, num_pruned
+
+
+def inside(
+        int[:] sentence,
+        int sent_len,
+        float[:,:] score,
+        int[:,:] live,
+        float[:,:] live_score,
+        int[:] num_live,
+        float[:,:] lexical,
+        int num_unary_rules,
+        int num_binary_rules,
+        int[:,:] lex_rules,
+        int[:,:] unary_rules,
+        int[:,:] binary_rules,
+        int[:,:] top_rules,
+        int[:] lex_offsets,
+        int[:] binary_offsets,
+        float[:] lex_logprob,
+        float[:] unary_logprob,
+        float[:] binary_logprob,
+        float[:] top_logprob,
+        int num_threads=1
+    ):
+    """Fill the inside chart, and return the sentence logprob, see fill_chart.
+
+    The root symbol holds the sentence logprob in the root cell. The other buffers
+    are as for cky.
+    """
+
+    cdef int i
+    cdef float logprob
+    cdef float total = -INFINITY
+    cdef int num_cells = cell(0, sent_len, sent_len) + 1
+
+    with nogil:
+        fill_chart(
+            INSIDE, sentence, sent_len, score, None, None, live, live_score, num_live, lexical,
+            num_unary_rules, lex_rules, unary_rules, binary_rules, top_rules,
+            lex_offsets, binary_offsets, lex_logprob, unary_logprob, binary_logprob, top_logprob,
+            num_threads, 0, 0, None, None)
+
+    # sum over the unary top-rules
+    for i in range(top_rules.shape[0]):
+        logprob = score[top_rules[i][1]][num_cells-1] + top_logprob[i]
+        if logprob > -INFINITY:
+            total = logprob if total == -INFINITY else log_add_exp(total, logprob)
+
+    return total
+
+
+cdef int fill_chart(
+        Semiring semiring,
+        int[:] sentence,
+        int sent_len,
+        float[:,:] score,
+        int[:,:] back_rule,
+        short[:,:] back_split,
+        int[:,:] live,
+        float[:,:] live_score,
+        int[:] num_live,
+        float[:,:] lexical,
+        int num_unary_rules,
+        int[:,:] lex_rules,
+        int[:,:] unary_rules,
+        int[:,:] binary_rules,
+        int[:,:] top_rules,
+        int[:] lex_offsets,
+        int[:] binary_offsets,
+        float[:] lex_logprob,
+        float[:] unary_logprob,
+        float[:] binary_logprob,
+        float[:] top_logprob,
+        int num_threads,
+        int beam,
+        float threshold,
+        unsigned char[:,:] allowed,
+        int[:] projection
+    ) noexcept nogil:
+    """Fill the chart of one sentence in the semiring, return the number of pruned items.
+
+    With VITERBI score holds the best derivation of each item and back_rule and back_split
+    its backpointer, see cky. With INSIDE score holds the sum over all derivations and the
+    backpointers are not used.
+
+    With beam > 0 each cell keeps at most its beam best items, and with threshold > 0
+    only the items within threshold of the best item in the cell. With allowed, an item
+    A is only kept in cell c if allowed[projection[A]][c], which is how coarse-to-fine
+    parsing prunes. The root cell is never pruned. With all of these off the chart is
+    exhaustive.
+    """
 
     cdef int i, j
-    cdef int span, begin, end, split
-    cdef int A, B, C, w
-    cdef float logprob, rule_prob
+    cdef int num_pruned = 0
+    cdef int span, begin, root
+    cdef int A, B, w
+    cdef float logprob
 
-    # recognize the lexical rules
+    # recognize the lexical rules, lexical keeps the scores of the tags
+    lexical_scores(sentence, sent_len, lexical, lex_rules, lex_offsets, lex_logprob)
     for i in range(sent_len):
-        for j in range(num_lex_rules):
-            A, w = lex_rules[j][0], lex_rules[j][1]  # A -> w
-            if w == sentence[i]:
-                score[A][i][i+1] = log(lex_prob[j])
+        w = sentence[i]
+        for j in range(lex_offsets[w], lex_offsets[w+1]):
+            A = lex_rules[j][0]  # A -> w
+            score[A][i] = lexical[A][i]  # cell (i, i+1) is cell i
 
     # recognize part of speech unary rules
     for i in range(sent_len):
         for j in range(num_unary_rules):
             A, B = unary_rules[j][0], unary_rules[j][1]  # A -> B
-            rule_prob = unary_prob[j]
-            logprob = score[B][i][i+1] + log(rule_prob)
-            if logprob > score[A][i][i+1]:
-                score[A][i][i+1] = logprob
-                back[A][i][i+1][0] = -2
-                back[A][i][i+1][1] = B
-                back[A][i][i+1][2] = -2
-
-    # recognize the binary rules
+            logprob = lexical[B][i] + unary_logprob[j]
+            add_item(semiring, score, back_rule, back_split, A, i, logprob, -2, j)
+
+    for i in range(sent_len):
+        num_live[i] = collect_live(score, live, live_score, i)
+        if sent_len > 1:
+            num_pruned += prune_cell(
+                score, live, live_score, num_live, i, beam, threshold, allowed, projection)
+
+    # recognize the binary rules, the cells of one span are independent
     for span in range(2, sent_len + 1):
-        for begin in range(0, sent_len - span + 1):
-            end = begin + span
-            for split in range(begin + 1, end):
-                for i in range(num_binary_rules):
-                    A, B, C = binary_rules[i][0], binary_rules[i][1], binary_rules[i][2]  # A -> B C
-                    rule_prob = binary_prob[i]
-                    logprob = score[B][begin][split] + score[C][split][end] + log(rule_prob)
-                    if logprob > score[A][begin][end]:
-                        score[A][begin][end] = logprob
-                        back[A][begin][end][0] = split
-                        back[A][begin][end][1] = B
-                        back[A][begin][end][2] = C
+        for begin in prange(sent_len - span + 1, num_threads=num_threads, schedule='dynamic'):
+            if span < sent_len:
+                num_pruned += fill_cell(
+                    semiring, begin, begin + span, sent_len, score, back_rule, back_split, live, live_score, num_live,
+                    binary_rules, binary_offsets, binary_logprob, beam, threshold, allowed, projection)
+            else:
+                num_pruned += fill_cell(
+                    semiring, begin, begin + span, sent_len, score, back_rule, back_split, live, live_score, num_live,
+                    binary_rules, binary_offsets, binary_logprob, 0, 0, None, None)
 
     # recognize the unary top-rules
-    begin, end = 0, sent_len
+    root = cell(0, sent_len, sent_len)
+    if semiring == INSIDE:
+        for i in range(top_rules.shape[0]):
+            score[top_rules[i][0]][root] = -INFINITY
     for i in range(top_rules.shape[0]):
         A, B = top_rules[i][0], top_rules[i][1]  # A -> B
-        rule_prob = top_prob[i]
-        logprob = score[B][begin][end] + log(rule_prob)
-        if logprob > score[A][begin][end]:
-            score[A][begin][end] = logprob
-            back[A][begin][end][0] = -2
-            back[A][begin][end][1] = B
-            back[A][begin][end][2] = -2
+        logprob = score[B][root] + top_logprob[i]
+        add_item(semiring, score, back_rule, back_split, A, root, logprob, -3, i)
 
-    return score, back
+    return num_pruned
 
 
-def inside(
+cdef int fill_cell(
+        Semiring semiring,
+        int begin,
+        int end,
+        int sent_len,
+        float[:,:] score,
+        int[:,:] back_rule,
+        short[:,:] back_split,
+        int[:,:] live,
+        float[:,:] live_score,
+        int[:] num_live,
+        int[:,:] binary_rules,
+        int[:] binary_offsets,
+        float[:] binary_logprob,
+        int beam,
+        float threshold,
+        unsigned char[:,:] allowed,
+        int[:] projection
+    ) noexcept nogil:
+    """Fill cell (begin, end) of the chart from the binary rules, return the number of pruned items."""
+
+    cdef int i, j
+    cdef int split, parent, left_cell, right_cell
+    cdef int A, B, C
+    cdef float logprob, left, right
+
+    parent = cell(begin, end, sent_len)
+    if allowed is not None and not any_allowed(allowed, parent):
+        num_live[parent] = 0
+        return 0
+
+    for split in range(begin + 1, end):
+        left_cell, right_cell = cell(begin, split, sent_len), cell(split, end, sent_len)
+        # join the live left children with the rule index, see PCFG.binary_offsets
+        for j in range(num_live[left_cell]):
+            B = live[left_cell][j]
+            left = live_score[left_cell][j]
+            for i in range(binary_offsets[B], binary_offsets[B+1]):
+                C = binary_rules[i][2]  # A -> B C
+                right = score[C][right_cell]
+                if right == -INFINITY:
+                    continue
+                A = binary_rules[i][0]
+                logprob = left + right + binary_logprob[i]
+                add_item(semiring, score, back_rule, back_split, A, parent, logprob, split, i)
+    num_live[parent] = collect_live(score, live, live_score, parent)
+    return prune_cell(score, live, live_score, num_live, parent, beam, threshold, allowed, projection)
+
+
+cdef inline void add_item(
+        Semiring semiring,
+        float[:,:] score,
+        int[:,:] back_rule,
+        short[:,:] back_split,
+        int A,
+        int c,
+        float logprob,
+        int split,
+        int rule
+    ) noexcept nogil:
+    """Combine a derivation of A in cell c into the chart, in the semiring."""
+    if semiring == INSIDE:
+        add_log(score, A, c, logprob)
+    elif logprob > score[A][c]:
+        score[A][c] = logprob
+        back_rule[A][c] = rule
+        back_split[A][c] = split
+
+
+def outside(
         int[:] sentence,
         int sent_len,
-        float[:,:,:] score,
-        int num_lex_rules,
+        float[:,:] score,
+        float[:,:] outside_score,
+        float[:,:] lexical,
+        float[:,:] unary_outside,
         int num_unary_rules,
-        int num_binary_rules,
         int num_nonterminals,
         int[:,:] lex_rules,
         int[:,:] unary_rules,
         int[:,:] binary_rules,
         int[:,:] top_rules,
-        float[:] lex_prob,
-        float[:] unary_prob,
-        float[:] binary_prob,
-        float[:] top_prob,
+        int[:] lex_offsets,
+        int[:] binary_offsets,
+        float[:] lex_logprob,
+        float[:] unary_logprob,
+        float[:] binary_logprob,
+        float[:] top_logprob,
     ):
+    """Fill outside_score given the chart score computed by inside.
+
+    Afterwards score + outside_score - logprob is the log posterior of each item, with
+    logprob the sentence score returned by inside. For this, in the cells of length one,
+    outside_score also counts the tags as children of the unary rules.
+
+    The outside chart must be filled with -inf. lexical and unary_outside are buffers of
+    shape (num_nonterminals, sent_len) for the tags, see parser.ChartArena.
+    """
 
     cdef int i, j
     cdef int span, begin, end, split
-    cdef int A, B, C, w
-    cdef float logprob, rule_prob
+    cdef int parent_cell, left_cell, right_cell
+    cdef int A, B, C
+    cdef float parent, logprob, left, right, item
 
-    for i in range(sent_len):
-        for j in range(num_lex_rules):
-            A, w = lex_rules[j][0], lex_rules[j][1]  # A -> w
-            if w == sentence[i]:
-                score[A][i][i+1] = log(lex_prob[j])
+    lexical_scores(sentence, sent_len, lexical, lex_rules, lex_offsets, lex_logprob)
+    for A in range(num_nonterminals):
+        for i in range(sent_len):
+            unary_outside[A][i] = -INFINITY
 
-    # recognize part of speech unary rules
-    for i in range(sent_len):
-        for j in range(num_unary_rules):
-            A, B = unary_rules[j][0], unary_rules[j][1]  # A -> B
-            rule_prob = unary_prob[j]
-            logprob = score[B][i][i+1] + log(rule_prob)
-            if logprob > score[A][i][i+1]:
-                score[A][i][i+1] = logprob
+    # the root symbol, and the unary top-rules
+    parent_cell = cell(0, sent_len, sent_len)
+    for i in range(top_rules.shape[0]):
+        outside_score[top_rules[i][0]][parent_cell] = 0
+    for i in range(top_rules.shape[0]):
+        A, B = top_rules[i][0], top_rules[i][1]  # A -> B
+        add_log(outside_score, B, parent_cell, top_logprob[i])
 
-    # sum over the binary rules
-    for span in range(2, sent_len + 1):
+    # the binary rules, top-down
+    for span in range(sent_len, 1, -1):
         for begin in range(0, sent_len - span + 1):
             end = begin + span
+            parent_cell = cell(begin, end, sent_len)
             for split in range(begin + 1, end):
-                for i in range(num_binary_rules):
-                    A, B, C = binary_rules[i][0], binary_rules[i][1], binary_rules[i][2]  # A -> B C
-                    rule_prob = binary_prob[i]
-                    logprob = score[B][begin][split] + score[C][split][end] + log(rule_prob)
-                    # accumulate sums (in log domain)
-                    if score[A][begin][end] == -INFINITY:
-                        score[A][begin][end] = logprob
-                    else:
-                        score[A][begin][end] = log_add_exp(logprob, score[A][begin][end])
-
-    # sum over the unary top-rules:
-    begin, end = 0, sent_len
-    inside = -INFINITY  # accumulator
+                left_cell, right_cell = cell(begin, split, sent_len), cell(split, end, sent_len)
+                for B in range(num_nonterminals):
+                    left = score[B][left_cell]
+                    if left == -INFINITY:
+                        continue
+                    for i in range(binary_offsets[B], binary_offsets[B+1]):
+                        A, C = binary_rules[i][0], binary_rules[i][2]  # A -> B C
+                        parent = outside_score[A][parent_cell]
+                        right = score[C][right_cell]
+                        if parent == -INFINITY or right == -INFINITY:
+                            continue
+                        logprob = parent + binary_logprob[i]
+                        add_log(outside_score, B, left_cell, logprob + right)
+                        add_log(outside_score, C, right_cell, logprob + left)
+
+    # the part of speech unary rules, where in a sentence of one word the top rules,
+    # which are also unary rules, already gave their outside score above
+    for i in range(sent_len):
+        for j in range(num_unary_rules):
+            A, B = unary_rules[j][0], unary_rules[j][1]  # A -> B
+            if sent_len == 1 and is_top(top_rules, A):
+                continue
+            parent = outside_score[A][i]
+            if parent == -INFINITY or lexical[B][i] == -INFINITY:
+                continue
+            logprob = parent + unary_logprob[j]
+            if unary_outside[B][i] == -INFINITY:
+                unary_outside[B][i] = logprob
+            else:
+                unary_outside[B][i] = log_add_exp(logprob, unary_outside[B][i])
+
+    # fold the tags under unary rules into the outside scores of the cells of length one
+    for i in range(sent_len):
+        for A in range(num_nonterminals):
+            if unary_outside[A][i] == -INFINITY:
+                continue
+            item = lexical[A][i] + unary_outside[A][i]
+            if outside_score[A][i] > -INFINITY:
+                item = log_add_exp(item, score[A][i] + outside_score[A][i])
+            outside_score[A][i] = item - score[A][i]
+
+    return outside_score
+
+
+cdef void lexical_scores(
+        int[:] sentence,
+        int sent_len,
+        float[:,:] lexical,
+        int[:,:] lex_rules,
+        int[:] lex_offsets,
+        float[:] lex_logprob
+    ) noexcept nogil:
+    """Fill lexical, of shape (num_nonterminals, sent_len), with the lexical rule scores of the tags of each word."""
+    cdef int i, j, w
+    for j in range(lexical.shape[0]):
+        for i in range(sent_len):
+            lexical[j][i] = -INFINITY
+    for i in range(sent_len):
+        w = sentence[i]
+        # only the tags of word w, see PCFG.lexical_offsets
+        for j in range(lex_offsets[w], lex_offsets[w+1]):
+            lexical[lex_rules[j][0]][i] = lex_logprob[j]  # A -> w
+
+
+cdef inline bint is_top(int[:,:] top_rules, int A) noexcept nogil:
+    """Whether A is the left-hand side of a top rule."""
+    cdef int i
     for i in range(top_rules.shape[0]):
-        A, B = top_rules[i][0], top_rules[i][1]  # A -> B
-        rule_prob = top_prob[i]
-        logprob = score[B][begin][end] + log(rule_prob)
-        if logprob > -INFINITY:
-           if inside == -INFINITY:
-               inside = logprob  # first assingment
-           else:
-               inside = log_add_exp(inside, logprob)
+        if top_rules[i][0] == A:
+            return True
+    return False
+
+
+cdef inline int cell(int begin, int end, int sent_len) noexcept nogil:
+    """The index of cell (begin, end), the same as cky.chart.cell."""
+    cdef int span = end - begin
+    return (span - 1) * (sent_len + 1) - (span - 1) * span // 2 + begin
+
+
+cdef void add_log(float[:,:] chart, int A, int c, float logprob) noexcept nogil:
+    """Add logprob to chart[A][c] in the log domain."""
+    if logprob == -INFINITY:
+        return
+    if chart[A][c] == -INFINITY:
+        chart[A][c] = logprob
+    else:
+        chart[A][c] = log_add_exp(logprob, chart[A][c])
+
+
+cdef int collect_live(
+        float[:,:] score,
+        int[:,:] live,
+        float[:,:] live_score,
+        int c
+    ) noexcept nogil:
+    """Pack the nonterminals with a finite score in cell c, return their number."""
+    cdef int A
+    cdef int n = 0
+    for A in range(score.shape[0]):
+        if score[A][c] > -INFINITY:
+            live[c][n] = A
+            live_score[c][n] = score[A][c]
+            n += 1
+    return n
+
+
+cdef int prune_cell(
+        float[:,:] score,
+        int[:,:] live,
+        float[:,:] live_score,
+        int[:] num_live,
+        int c,
+        int beam,
+        float threshold,
+        unsigned char[:,:] allowed,
+        int[:] projection
+    ) noexcept nogil:
+    """Prune the live items of cell c, return their number, see fill_chart."""
+    cdef int j, A
+    cdef int n = num_live[c]
+    cdef int kept = 0
+    cdef float cutoff = -INFINITY
+    cdef float best = -INFINITY
+    cdef float* ranked
+
+    if n == 0 or (beam <= 0 and threshold <= 0 and allowed is None):
+        return 0
+
+    if threshold > 0:
+        for j in range(n):
+            if live_score[c][j] > best:
+                best = live_score[c][j]
+        cutoff = best - threshold
+    if 0 < beam < n:
+        ranked = <float*> malloc(n * sizeof(float))
+        for j in range(n):
+            ranked[j] = live_score[c][j]
+        qsort(ranked, n, sizeof(float), descending)
+        if ranked[beam-1] > cutoff:
+            cutoff = ranked[beam-1]
+        free(ranked)
+
+    for j in range(n):
+        A = live[c][j]
+        if live_score[c][j] >= cutoff and (allowed is None or allowed[projection[A]][c]):
+            live[c][kept] = A
+            live_score[c][kept] = live_score[c][j]
+            kept += 1
+        else:
+            score[A][c] = -INFINITY
+    num_live[c] = kept
+    return n - kept
+
+
+cdef bint any_allowed(unsigned char[:,:] allowed, int c) noexcept nogil:
+    cdef int A
+    for A in range(allowed.shape[0]):
+        if allowed[A][c]:
+            return True
+    return False
+
 
-    return inside
+cdef int descending(const void* a, const void* b) noexcept nogil:
+    cdef float x = (<float*> a)[0]
+    cdef float y = (<float*> b)[0]
+    return (x < y) - (x > y)
 
 
-cdef float log_add_exp(float a, float b):
+cdef float log_add_exp(float a, float b) noexcept nogil:
     """Compute log(exp(a) + exp(b)) in a numerically stable way."""
     if a - b < b - a:  # choose the smaller exponent
         return b + log(1 + exp(a - b))
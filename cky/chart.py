@@ -0,0 +1,18 @@
+"""
+Indexing of the triangular charts.
+
+A chart holds only the cells (begin, end) with begin < end, ordered by
+span length and then by begin: first the n cells of length one, then the
+n-1 cells of length two, and so on up to the root cell (0, n). So cell
+(i, i+1) is cell i, and the cells of one span are contiguous.
+"""
+
+
+def num_cells(sent_len):
+    return sent_len * (sent_len + 1) // 2
+
+
+def cell(begin, end, sent_len):
+    """The index of cell (begin, end), also for arrays of begins and ends."""
+    span = end - begin
+    return (span - 1) * (sent_len + 1) - (span - 1) * span // 2 + begin
@@ -1,47 +1,100 @@
 """
 A Numpy CKY.
 
-This cky is almost identical to _cky.pyx, but not typed,
-and not cythonized, and is around 80 times slower.
+This cky computes the same chart as _cky.pyx, but vectorized: for each
+cell the scores of all binary rules at all split points are computed at
+once, and reduced onto their left-hand sides with a max-plus reduction.
+The charts are triangular, see cky/chart.py.
 """
 
 import numpy as np
 
+from cky.chart import cell, num_cells
+
+
 def cky(
-    sentence,
-    score,
-    back,
-    lex_rules,
-    unary_rules,
-    binary_rules,
-    lex_prob,
-    unary_prob,
-    binary_prob
-    ):
+        sentence,
+        score,
+        back_rule,
+        back_split,
+        lex_rules,
+        unary_rules,
+        binary_rules,
+        top_rules,
+        lex_offsets,
+        lex_logprob,
+        unary_logprob,
+        binary_logprob,
+        top_logprob
+):
 
+    """Fill the Viterbi chart and the backpointers, encoded as in _cky.cky."""
     sent_len = sentence.shape[0]
-    num_lex_rules = lex_rules.shape[0]
-    num_unary_rules = lex_rules.shape[0]
-    num_binary_rules = lex_rules.shape[0]
+    words = slice(0, sent_len)  # cell (i, i+1) is cell i
 
-    for i in range(sent_len):
-        for j in range(num_lex_rules):
-            A, w = lex_rules[j][0], lex_rules[j][1]  # A -> w
-            if w == sentence[i]:
-                score[A][i][i+1] = np.log(lex_prob[j])
+    # recognize the lexical rules
+    for i, w in enumerate(sentence):
+        rules = slice(lex_offsets[w], lex_offsets[w+1])
+        score[lex_rules[rules, 0], i] = lex_logprob[rules]
 
+    # recognize part of speech unary rules, for all words at once
+    A, B = unary_rules[:, 0], unary_rules[:, 1]  # A -> B
+    logprob = score[B, words] + unary_logprob[:, None]
+    best, rule = max_by_lhs(A, logprob, score.shape[0])
+    update = best > score[:, words]
+    A, i = np.nonzero(update)
+    score[A, i] = best[A, i]
+    back_rule[A, i] = rule[A, i]
+    back_split[A, i] = -2
+
+    # recognize the binary rules
+    A, B, C = binary_rules[:, 0], binary_rules[:, 1], binary_rules[:, 2]  # A -> B C
     for span in range(2, sent_len + 1):
         for begin in range(0, sent_len - span + 1):
             end = begin + span
-            for split in range(begin + 1, end):
-                for i in range(num_binary_rules):
-                    A, B, C = binary_rules[i][0], binary_rules[i][1], binary_rules[i][2]
-                    rule_prob = binary_prob[i]
-                    prob = score[B][begin][split] + score[C][split][end] + np.log(rule_prob)
-                    if prob > score[A][begin][end]:
-                        score[A][begin][end] = prob
-                        back[A][begin][end][0] = split
-                        back[A][begin][end][1] = B
-                        back[A][begin][end][2] = C
-
-    return score, back
+            splits = np.arange(begin + 1, end)
+            left = score[:, cell(begin, splits, sent_len)]  # all left cells
+            right = score[:, cell(splits, end, sent_len)]  # all right cells
+            # only the rules with both children alive for some split
+            alive = np.isfinite(left).any(axis=1)[B] & np.isfinite(right).any(axis=1)[C]
+            rules = np.flatnonzero(alive)
+            if rules.size == 0:
+                continue
+            logprob = left[B[rules]] + right[C[rules]] + binary_logprob[rules, None]
+            split = logprob.argmax(axis=1)
+            logprob = logprob[np.arange(rules.size), split]
+            best, winner = max_by_lhs(A[rules], logprob[:, None], score.shape[0])
+            lhs = np.flatnonzero(np.isfinite(best[:, 0]))
+            winner = winner[lhs, 0]
+            parent = cell(begin, end, sent_len)
+            score[lhs, parent] = best[lhs, 0]
+            back_rule[lhs, parent] = rules[winner]
+            back_split[lhs, parent] = splits[split[winner]]
+
+    # recognize the unary top-rules
+    root = num_cells(sent_len) - 1
+    A, B = top_rules[:, 0], top_rules[:, 1]  # A -> B
+    logprob = score[B, root] + top_logprob
+    best, rule = max_by_lhs(A, logprob[:, None], score.shape[0])
+    lhs = np.flatnonzero(best[:, 0] > score[:, root])
+    score[lhs, root] = best[lhs, 0]
+    back_rule[lhs, root] = rule[lhs, 0]
+    back_split[lhs, root] = -3
+
+    return score, back_rule, back_split
+
+
+def max_by_lhs(lhs, logprob, num_nonterminals):
+    """Max-reduce the rows of logprob onto their left-hand sides.
+
+    Returns the best score per nonterminal and column, and the (first)
+    row that attains it, or -1 where no row has a finite score.
+    """
+    best = np.full((num_nonterminals, logprob.shape[1]), -np.inf, dtype=logprob.dtype)
+    np.maximum.at(best, lhs, logprob)
+    rows, cols = np.nonzero((logprob == best[lhs]) & np.isfinite(logprob))
+    # nonzero is row-major, so unique keeps the first row per (lhs, column)
+    keys, first = np.unique(lhs[rows] * logprob.shape[1] + cols, return_index=True)
+    rule = np.full(best.shape, -1, dtype=np.int64)
+    rule.flat[keys] = rows[first]
+    return best, rule
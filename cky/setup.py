@@ -1,15 +1,20 @@
+import sys
 from distutils.core import setup
 from distutils.extension import Extension
 from Cython.Distutils import build_ext
 
 import numpy
 
+# OpenMP for the parallel CKY, the default clang on macOS does not ship it
+openmp = [] if sys.platform == 'darwin' else ["-fopenmp"]
+
 ext_modules = [
     Extension(
         "_cky",
         sources=["_cky.pyx"],
         include_dirs=[numpy.get_include()],
-        extra_compile_args=["-ffast-math"]
+        extra_compile_args=["-ffast-math"] + openmp,
+        extra_link_args=openmp
     )
 ]
 
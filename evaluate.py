@@ -1,7 +1,259 @@
-import os
-import subprocess
+"""Score predicted trees against gold trees on labeled brackets, like EVALB.
 
-from PYEVALB import scorer, parser
+The scores follow the COLLINS.prm parameters of EVALB: the words tagged with
+punctuation and traces are deleted before the brackets are collected, the
+root and preterminal brackets are not counted, function tags are stripped
+from the labels, ADVP and PRT count as the same label, and a bracket that
+appears twice in a tree must also be predicted twice.
+"""
+import re
+import multiprocessing as mp
+from collections import Counter, namedtuple
+from itertools import islice
+
+from PYEVALB import scorer
+
+
+DELETE_LABELS = {'TOP', 'ROOT', '', '-NONE-', ',', ':', '``', "''", '.'}
+DELETE_LABELS_FOR_LENGTH = {'-NONE-'}
+EQUAL_LABELS = {'PRT': 'ADVP'}
+CUTOFF_LENGTH = 40
+
+TOKENS = re.compile(r'\(|\)|[^\s()]+')
+
+
+SENTENCE_FIELDS = 'length gold test match crossing words tags error'
+
+
+class SentenceScore(namedtuple('SentenceScore', SENTENCE_FIELDS)):
+    """The bracket counts of one predicted tree, see score_sentence."""
+
+    @property
+    def precision(self):
+        return self.match / self.test if self.test else 0.
+
+    @property
+    def recall(self):
+        return self.match / self.gold if self.gold else 0.
+
+    @property
+    def fscore(self):
+        prec, recall = self.precision, self.recall
+        return 2 * prec * recall / (prec + recall) if prec + recall else 0.
+
+
+def base_label(label):
+    """The label without function tags (NP-SBJ, NP=2) and with equal labels merged."""
+    if not label.startswith('-'):  # e.g. -NONE- and -LRB-
+        label = re.split('[-=]', label)[0]
+    return EQUAL_LABELS.get(label, label)
+
+
+def read_brackets(tree):
+    """The words, tags and (label, begin, end) brackets of a one-line bracket string.
+
+    A bracket directly around a word is its tag, and a node without a label,
+    like the root of ( (S ...)), gets the label ''.
+    """
+    words, tags, brackets = [], [], []
+    stack = []  # [label, begin, is_tag] of each open node
+    expect_label = False
+    for token in TOKENS.findall(tree):
+        if token == '(':
+            if expect_label:
+                stack[-1][0] = ''
+            stack.append(['', len(words), False])
+            expect_label = True
+        elif token == ')':
+            label, begin, is_tag = stack.pop()
+            if is_tag:
+                tags.append(label)
+            else:
+                brackets.append((label, begin, len(words)))
+            expect_label = False
+        elif expect_label:
+            stack[-1][0] = token
+            expect_label = False
+        else:
+            words.append(token)
+            stack[-1][2] = True
+    return words, tags, brackets
+
+
+def labeled_spans(brackets, kept):
+    """The multiset of (label, begin, end) brackets, counted on the kept words only."""
+    position = [0]  # the position of each word among the kept words
+    for keep in kept:
+        position.append(position[-1] + keep)
+    spans = Counter()
+    for label, begin, end in brackets:
+        label = base_label(label)
+        begin, end = position[begin], position[end]
+        if label not in DELETE_LABELS and begin < end:
+            spans[label, begin, end] += 1
+    return spans
+
+
+def crosses(span, other):
+    (begin, end), (other_begin, other_end) = span, other
+    return begin < other_begin < end < other_end or other_begin < begin < other_end < end
+
+
+def score_sentence(gold, pred):
+    """Score the bracket string pred against the bracket string gold.
+
+    The words are aligned without the traces, and the sentence is an error
+    when they do not match. The gold tags decide which words are deleted
+    from both trees, so a mistagged punctuation word does not shift the spans.
+    """
+    gold_words, gold_tags, gold_brackets = read_brackets(gold)
+    pred_words, pred_tags, pred_brackets = read_brackets(pred)
+    gold_tags = [base_label(tag) for tag in gold_tags]
+    pred_tags = [base_label(tag) for tag in pred_tags]
+    gold_index = [i for i, tag in enumerate(gold_tags) if tag not in DELETE_LABELS_FOR_LENGTH]
+    pred_index = [i for i, tag in enumerate(pred_tags) if tag not in DELETE_LABELS_FOR_LENGTH]
+    length = len(gold_index)
+    if [gold_words[i] for i in gold_index] != [pred_words[i] for i in pred_index]:
+        return SentenceScore(length, 0, 0, 0, 0, 0, 0, error=True)
+
+    gold_kept = [tag not in DELETE_LABELS for tag in gold_tags]
+    pred_kept = [False] * len(pred_words)
+    for i, j in zip(gold_index, pred_index):
+        pred_kept[j] = gold_kept[i]
+    gold_spans = labeled_spans(gold_brackets, gold_kept)
+    pred_spans = labeled_spans(pred_brackets, pred_kept)
+
+    match = sum((gold_spans & pred_spans).values())
+    gold_unlabeled = {(begin, end) for _, begin, end in gold_spans}
+    crossing = sum(
+        count for (_, begin, end), count in pred_spans.items()
+        if any(crosses((begin, end), other) for other in gold_unlabeled))
+    aligned = [(i, j) for i, j in zip(gold_index, pred_index) if gold_kept[i]]
+    tags = sum(gold_tags[i] == pred_tags[j] for i, j in aligned)
+    return SentenceScore(
+        length, sum(gold_spans.values()), sum(pred_spans.values()), match, crossing,
+        len(aligned), tags, error=False)
+
+
+def unmatched(tree):
+    """The score of a tree that has no tree to be scored against."""
+    _, tags, _ = read_brackets(tree)
+    length = sum(tag not in DELETE_LABELS_FOR_LENGTH for tag in tags)
+    return SentenceScore(length, 0, 0, 0, 0, 0, 0, error=True)
+
+
+def score_pair(pair):
+    gold, pred = pair
+    return score_sentence(gold.strip(), pred.strip())
+
+
+class Totals:
+    """The summed scores of a set of sentences, with the summary statistics of EVALB."""
+
+    def __init__(self):
+        self.sentences = self.errors = 0
+        self.gold = self.test = self.match = 0
+        self.complete = self.crossing = self.no_crossing = self.two_crossing = 0
+        self.words = self.tags = 0
+
+    def add(self, score):
+        self.sentences += 1
+        if score.error:
+            self.errors += 1
+            return
+        self.gold += score.gold
+        self.test += score.test
+        self.match += score.match
+        self.complete += score.match == score.gold == score.test
+        self.crossing += score.crossing
+        self.no_crossing += score.crossing == 0
+        self.two_crossing += score.crossing <= 2
+        self.words += score.words
+        self.tags += score.tags
+
+    @property
+    def valid(self):
+        return self.sentences - self.errors
+
+    @property
+    def recall(self):
+        return 100 * self.match / self.gold if self.gold else 0.
+
+    @property
+    def precision(self):
+        return 100 * self.match / self.test if self.test else 0.
+
+    @property
+    def fscore(self):
+        prec, recall = self.precision, self.recall
+        return 2 * prec * recall / (prec + recall) if prec + recall else 0.
+
+    def summary(self):
+        valid = self.valid or 1
+        lines = [
+            ('Number of sentence', f'{self.sentences:6d}'),
+            ('Number of Error sentence', f'{self.errors:6d}'),
+            ('Number of Skip  sentence', f'{0:6d}'),
+            ('Number of Valid sentence', f'{self.valid:6d}'),
+            ('Bracketing Recall', f'{self.recall:6.2f}'),
+            ('Bracketing Precision', f'{self.precision:6.2f}'),
+            ('Bracketing FMeasure', f'{self.fscore:6.2f}'),
+            ('Complete match', f'{100 * self.complete / valid:6.2f}'),
+            ('Average crossing', f'{self.crossing / valid:6.2f}'),
+            ('No crossing', f'{100 * self.no_crossing / valid:6.2f}'),
+            ('2 or less crossing', f'{100 * self.two_crossing / valid:6.2f}'),
+            ('Tagging accuracy', f'{100 * self.tags / (self.words or 1):6.2f}'),
+        ]
+        return '\n'.join(f'{name:<26}= {value}' for name, value in lines)
+
+
+class Evalb:
+    """The totals over all sentences and over the sentences of at most cutoff words."""
+
+    def __init__(self, cutoff=CUTOFF_LENGTH):
+        self.cutoff = cutoff
+        self.all = Totals()
+        self.short = Totals()
+
+    def add(self, score):
+        self.all.add(score)
+        if score.length <= self.cutoff:
+            self.short.add(score)
+
+    def scored(self, trees, gold_path, skip=0, max_lines=None):
+        """Yield the predicted trees, scoring each against its line of gold_path as it passes.
+
+        The lines of gold_path are read as for read_sentences. Every tree is yielded,
+        and a tree without a gold line and a gold line without a tree, once the trees
+        run out, count as error sentences.
+        """
+        with open(gold_path) as fin:
+            golds = islice(fin, skip, max_lines)
+            for pred in trees:
+                gold = next(golds, None)
+                self.add(unmatched(pred) if gold is None else score_sentence(gold.strip(), pred))
+                yield pred
+            for gold in golds:
+                self.add(unmatched(gold.strip()))
+
+    def summary(self):
+        return '\n'.join([
+            '=== Summary ===', '',
+            '-- All --', self.all.summary(), '',
+            f'-- len<={self.cutoff} --', self.short.summary(), ''])
+
+    def write(self, result_path):
+        with open(result_path, 'w') as fout:
+            print(self.summary(), file=fout)
+
+
+def score_file(pred_path, gold_path, max_lines=None, processes=None, chunksize=256):
+    """Score the trees of pred_path against those of gold_path line by line, in parallel chunks."""
+    evalb = Evalb()
+    with open(gold_path) as gold, open(pred_path) as pred, mp.Pool(processes) as pool:
+        for score in pool.imap(score_pair, islice(zip(gold, pred), max_lines), chunksize):
+            evalb.add(score)
+    return evalb
 
 
 def pyevalb(pred_path, gold_path, result_path):
@@ -9,16 +261,14 @@ def pyevalb(pred_path, gold_path, result_path):
     scorer.Scorer().evalb(gold_path, pred_path, result_path)
 
 
-def evalb(evalb_dir, pred_path, gold_path, result_path, ignore_error=1000):
-    """Use original EVALB to score trees."""
-    evalb_dir = os.path.expanduser(evalb_dir)
-    assert os.path.exists(evalb_dir), f'Do you have EVALB installed at {evalb_dir}?'
-    evalb_exec = os.path.join(evalb_dir, "evalb")
-    command = '{} {} {} -e {} > {}'.format(
-        evalb_exec,
-        pred_path,
-        gold_path,
-        ignore_error,
-        result_path
-    )
-    subprocess.run(command, shell=True)
+def evalb(pred_path, gold_path, result_path, ignore_error=1000, processes=None):
+    """Score the trees like EVALB and write the summary to result_path.
+
+    Like EVALB with -e, give up when there are more than ignore_error
+    sentences whose words do not match the gold words.
+    """
+    evalb = score_file(pred_path, gold_path, processes=processes)
+    if evalb.all.errors > ignore_error:
+        raise ValueError(f'{evalb.all.errors} sentences do not match the gold trees.')
+    evalb.write(result_path)
+    return evalb
@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+"""Compare the speed of the CKY with the two chart layouts, see parser.ChartArena."""
+import time
+import argparse
+
+from parser import Parser
+
+
+def benchmark(parser, sentences, reps):
+    start = time.time()
+    for rep in range(reps):
+        for sentence in sentences:
+            parser.parse(sentence, verbose=False)
+    return (time.time() - start) / reps
+
+
+def main(args):
+    with open(args.infile) as f:
+        sentences = [line.split() for line in f if line.strip()][:args.num_lines]
+    print(f'Parsing {len(sentences)} sentences from `{args.infile}`.')
+
+    for grammar in args.grammars:
+        for cell_major in (False, True):
+            parser = Parser(grammar, num_threads=args.threads, cell_major=cell_major)
+            parser.parse(sentences[0], verbose=False)  # warm up the charts
+            elapsed = benchmark(parser, sentences, args.reps)
+            layout = 'cell-major' if cell_major else 'nonterminal-major'
+            print(f'{grammar} {layout}: {elapsed:.3f}s')
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('--grammars', type=str, nargs='+', default=[
+        'grammar/train/train.vanilla.grammar', 'grammar/train/train.markov.v1h1.grammar'])
+    argparser.add_argument('--infile', type=str, default='grammar/dev/dev.tokens')
+    argparser.add_argument('-n', '--num-lines', type=int, default=100)
+    argparser.add_argument('--reps', type=int, default=3)
+    argparser.add_argument('--threads', type=int, default=1)
+    args = argparser.parse_args()
+
+    main(args)
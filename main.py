@@ -1,21 +1,36 @@
 #!/usr/bin/env python
 import os
+import sys
 import argparse
 import time
+from contextlib import redirect_stdout
 
 import numpy as np
 from nltk import tokenize, Tree
 
 from parser import Parser
-from predict import predict_from_trees, predict_from_file, predict_from_file_parallel
-from evaluate import evalb
+from cache import ParseCache
+from predict import (
+    predict_from_trees, predict_from_file, predict_from_file_parallel, write_trees, Checkpoint,
+    ParseCounts)
+from evaluate import Evalb, score_file
 from syneval import syneval
 from utils import show, SENT, GOLD
 
 
 def main(args):
 
-    parser = Parser(args.grammar, args.expand_binaries)
+    parser = Parser(
+        args.grammar,
+        args.expand_binaries,
+        args.threads,
+        cache=not args.no_cache,
+        beam=args.beam,
+        threshold=args.threshold,
+        coarse_threshold=args.coarse_threshold,
+        cell_major=args.cell_major,
+        parse_cache=ParseCache(args.parse_cache) if args.parse_cache else None
+    )
     print(
         'Grammar rules:',
         f'{parser.grammar.num_lexical_rules:,} lexical,',
@@ -28,29 +43,53 @@ def main(args):
         print(f'Predicting trees for tokens in `{args.infile}`.')
         print(f'Writing trees to file `{args.outfile}`...')
 
+        # with --outfile - the trees go to stdout, and the messages to stderr, see below
+        checkpoint = None if args.outfile == '-' else Checkpoint(args.outfile)
+        num_done, size = checkpoint.load() if args.resume and checkpoint else (0, 0)
+        if num_done:
+            print(f'Resuming after {num_done} sentences.')
+
+        counts = ParseCounts()  # of the sentences of this run
         if args.parallel:
             trees = predict_from_file_parallel(
-                parser, args.infile, args.num_lines, args.tokenize)
+                parser, args.infile, args.num_lines, args.tokenize, skip=num_done, counts=counts)
         else:
             trees = predict_from_file(
-                parser, args.infile, args.num_lines, args.tokenize)
+                parser, args.infile, args.num_lines, args.tokenize, skip=num_done, counts=counts)
 
-        with open(args.outfile, 'w') as fout:
-            print('\n'.join(trees), file=fout)
+        # score each tree as it is written, and the trees of an earlier run from the file
+        if args.goldfile:
+            evalb = score_file(args.outfile, args.goldfile, num_done) if num_done else Evalb()
+            trees = evalb.scored(trees, args.goldfile, skip=num_done, max_lines=args.num_lines)
 
-        if args.show:
+        if args.outfile == '-':
+            fout = sys.__stdout__
+        else:
+            fout = open(args.outfile, 'a' if num_done else 'w')
+            fout.truncate(size)  # a tree that was written after the checkpoint
+            fout.seek(size)
+        try:
+            write_trees(trees, fout, checkpoint, num_done)
+            if checkpoint:
+                checkpoint.remove()
+        except KeyboardInterrupt:
+            exit('Prediction interrupted, rerun with --resume to continue.')
+        finally:
+            if fout is not sys.__stdout__:
+                fout.close()
+        counts.report()
+
+        if args.show and args.outfile != '-':
             show(args.outfile)
 
-        print('Evaluating bracket score...')
         if args.goldfile:
-            try:
-                evalb(args.evalb_dir, args.outfile, args.goldfile, args.result, args.ignore_empty)
-                if args.show:
-                    show(args.result)
-            except:
-                exit('Could not evaluate trees. Maybe you did not parse the entire file?')
-
-        print(f'Finished. Results saved to `{args.result}`.')
+            if evalb.all.errors > args.ignore_empty:
+                exit(f'Could not evaluate trees: {evalb.all.errors} do not match the gold trees.')
+            evalb.write(args.result)
+            print(f'Bracketing FMeasure = {evalb.all.fscore:.2f}')
+            if args.show:
+                show(args.result)
+            print(f'Finished. Results saved to `{args.result}`.')
 
     elif args.treefile:
         num_trees = 10 if args.num_lines == None else args.num_lines
@@ -120,23 +159,47 @@ if __name__ == '__main__':
 
     argparser.add_argument('--grammar', type=str, default='grammar/train/train.vanilla.grammar')
     argparser.add_argument('--sent', type=str, default='')
-    argparser.add_argument('--infile', type=str, default='')
-    argparser.add_argument('--outfile', type=str, default='pred.trees')
+    argparser.add_argument('--infile', type=str, default='', help='sentences to parse, - for stdin')
+    argparser.add_argument('--outfile', type=str, default='pred.trees',
+                           help='predicted trees, - for stdout')
     argparser.add_argument('--goldfile', type=str, default='')
     argparser.add_argument('--syneval', type=str, default='')
     argparser.add_argument('--result', type=str, default='result.txt')
     argparser.add_argument('--treefile', type=str, default='')
-    argparser.add_argument('--evalb_dir', type=str, default='EVALB')
     argparser.add_argument('--use-numpy', action='store_true')
     argparser.add_argument('--perplexity', action='store_true')
     argparser.add_argument('--short', action='store_true')
     argparser.add_argument('-n', '--num-lines', type=int, default=None)
-    argparser.add_argument('-q', '--ignore-empty', type=int, default=1000, help='let evalb ignore empty lines')
+    argparser.add_argument('-q', '--ignore-empty', type=int, default=1000,
+                           help='number of trees that may not match the gold trees')
     argparser.add_argument('-t', '--tokenize', action='store_true')
     argparser.add_argument('-p', '--parallel', action='store_true')
+    argparser.add_argument('--resume', action='store_true',
+                           help='continue parsing --infile after the trees already in --outfile')
     argparser.add_argument('-s', '--show', action='store_true')
-    argparser.add_argument('-b', '--expand-binaries', action='store_true', help='expand binary rules with each possible unary')
+    argparser.add_argument('--beam', type=int, default=0,
+                           help='keep only the best items per chart cell (0 is exhaustive)')
+    argparser.add_argument('--threshold', type=float, default=0,
+                           help='prune items this far in logprob below the best in their cell '
+                                '(0 is no pruning)')
+    argparser.add_argument('--coarse-threshold', type=float, default=0,
+                           help='coarse-to-fine: prune items with a coarse posterior below this '
+                                '(0 is no pruning)')
+    argparser.add_argument('--no-cache', action='store_true',
+                           help='do not use or write the compiled grammar cache')
+    argparser.add_argument('--parse-cache', type=str, default='',
+                           help='sqlite file to keep and reuse parses and perplexities')
+    argparser.add_argument('--cell-major', action='store_true',
+                           help='lay out the charts with the nonterminals of a cell contiguous')
+    argparser.add_argument('--threads', type=int, default=1,
+                           help='threads for the cells of a span in the cython CKY')
+    argparser.add_argument('-b', '--expand-binaries', action='store_true',
+                           help='expand binary rules with each possible unary')
 
     args = argparser.parse_args()
 
-    main(args)
+    if args.outfile == '-':
+        with redirect_stdout(sys.stderr):
+            main(args)
+    else:
+        main(args)
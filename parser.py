@@ -1,140 +1,483 @@
 import numpy as np
 from tqdm import tqdm
 from nltk import Tree
-from PYEVALB import scorer
-from PYEVALB import parser as evalb_parser
 
 from pcfg import PCFG
-from utils import process_sentence
-from cky import _cky, cky_numpy
+from cache import LEAF, fill_leaves
+from evaluate import score_sentence
+from cky import _cky, chart, cky_numpy
+
+
+class ChartArena:
+    """Charts and work buffers of the CKY and the inside-outside, reused from sentence to sentence.
+
+    Each kind of chart lives in a flat buffer that grows to the longest sentence
+    seen, and each call resets only the part that the sentence uses. A chart is
+    a view into a buffer, so it is only valid until the next call for the same
+    kind of chart.
+
+    The charts are always indexed [A, c]. With cell_major the memory is laid out
+    as [c, A] instead, so that the nonterminals of one cell are contiguous.
+    """
+
+    def __init__(self, num_nonterminals, cell_major=False):
+        self.num_nonterminals = num_nonterminals
+        self.cell_major = cell_major
+        self._score = np.empty(0, dtype=np.float32)
+        self._rule = np.empty(0, dtype=np.int32)
+        self._split = np.empty(0, dtype=np.int16)
+        self._outside = np.empty(0, dtype=np.float32)
+        self._live = np.empty(0, dtype=np.int32)
+        self._live_score = np.empty(0, dtype=np.float32)
+        self._num_live = np.empty(0, dtype=np.int32)
+        self._lexical = np.empty(0, dtype=np.float32)
+        self._unary_outside = np.empty(0, dtype=np.float32)
+
+    def score(self, sent_len):
+        """A chart of shape (num_nonterminals, num_cells) filled with -inf, see cky/chart.py."""
+        self._score, score = self._chart(self._score, sent_len)
+        score.fill(-np.inf)
+        return score
+
+    def outside(self, sent_len):
+        """An outside chart for _cky.outside, like the score chart."""
+        self._outside, outside = self._chart(self._outside, sent_len)
+        outside.fill(-np.inf)
+        return outside
+
+    def back(self, sent_len):
+        """Backpointers as a pair of rule and split charts, see _cky.cky.
+
+        Both have the shape of the score chart. The splits are filled with -1, and
+        the rules are only read where the split is set, so they are not reset.
+        """
+        self._rule, rule = self._chart(self._rule, sent_len)
+        self._split, split = self._chart(self._split, sent_len)
+        split.fill(-1)
+        return rule, split
+
+    def live(self, sent_len):
+        """The live lists of the cells as live, live_score and num_live, see _cky.cky.
+
+        The kernels write the list of each cell before they read it, so they are not reset.
+        """
+        shape = (chart.num_cells(sent_len), self.num_nonterminals)
+        self._live, live = self._view(self._live, shape)
+        self._live_score, live_score = self._view(self._live_score, shape)
+        self._num_live, num_live = self._view(self._num_live, shape[:1])
+        return live, live_score, num_live
+
+    def lexical(self, sent_len):
+        """The lexical scores of the tags of each word, of shape (num_nonterminals, sent_len).
+
+        Filled by the kernels, see _cky.cky.
+        """
+        self._lexical, lexical = self._view(self._lexical, (self.num_nonterminals, sent_len))
+        return lexical
+
+    def unary_outside(self, sent_len):
+        """The outside scores of the tags under the unary rules, like lexical, see _cky.outside."""
+        self._unary_outside, unary_outside = self._view(
+            self._unary_outside, (self.num_nonterminals, sent_len))
+        return unary_outside
+
+    def __getstate__(self):
+        # a worker process starts with empty buffers
+        return self.num_nonterminals, self.cell_major
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def _chart(self, buffer, sent_len):
+        shape = (self.num_nonterminals, chart.num_cells(sent_len))
+        if not self.cell_major:
+            return self._view(buffer, shape)
+        buffer, view = self._view(buffer, shape[::-1])
+        return buffer, view.T
+
+    def _view(self, buffer, shape):
+        size = np.prod(shape)
+        if buffer.size < size:
+            buffer = np.empty(size, dtype=buffer.dtype)
+        return buffer, buffer[:size].reshape(shape)
 
 
 class Parser:
 
-    def __init__(self, grammar_path, expand_binaries=False):
-        self.grammar = PCFG.from_file(grammar_path, expand_binaries)
+    def __init__(
+            self,
+            grammar_path,
+            expand_binaries=False,
+            num_threads=1,
+            cache=True,
+            beam=0,
+            threshold=0,
+            coarse_threshold=0,
+            cell_major=False,
+            parse_cache=None
+    ):
+        if cache:
+            self.grammar = PCFG.from_file_cached(grammar_path, expand_binaries)
+        else:
+            self.grammar = PCFG.from_file(grammar_path, expand_binaries)
+        self.num_threads = num_threads  # for the cells of a span in the cython CKY
+        # pruning of the cython CKY: keep the beam best items per cell, and the
+        # items within threshold (in logprob) of the best in the cell, 0 is no pruning
+        self.beam = beam
+        self.threshold = threshold
+        # coarse-to-fine: prune the items whose projection onto the coarse grammar
+        # has a posterior below coarse_threshold, 0 is no pruning
+        self.coarse_threshold = coarse_threshold
+        self._coarse = None  # the coarse grammar, projection and charts, see coarse_mask
+        self.num_pruned = 0  # by the last call to the CKY
+        # shared by all the CKY calls, with cell_major the nonterminals of a cell are contiguous
+        self.charts = ChartArena(self.grammar.num_nonterminals, cell_major)
+        self._brackets = None  # see build_string
+        # a ParseCache for the string parses and the perplexities, see cache_namespace
+        self.parse_cache = parse_cache
+        self.fingerprint = None if parse_cache is None else self.grammar.fingerprint()
+
+    def parse(
+            self,
+            sentence,
+            verbose=True,
+            use_numpy=False,
+            num_trees=10,
+            root='TOP',
+            beam=None,
+            threshold=None,
+            coarse_threshold=None,
+            as_string=False
+    ):
+        """Parse a sentence, returns the best tree and its logprob.
+
+        The tree is the binarized nltk.Tree, or with as_string the de-binarized
+        tree as a one-line bracket string, see build_string. Only the latter are
+        kept in the parse cache.
+        """
+        beam = self.beam if beam is None else beam
+        threshold = self.threshold if threshold is None else threshold
+        coarse_threshold = self.coarse_threshold if coarse_threshold is None else coarse_threshold
+        sentence_array = self.grammar.process_sentence(sentence)
+        cached = as_string and self.parse_cache is not None
+        if cached:
+            namespace = self.cache_namespace(
+                'parse', root, beam, threshold, coarse_threshold, use_numpy)
+            result = self.parse_cache.get(namespace, sentence_array)
+            if result is not None:
+                self.num_pruned = 0
+                tree, score = result
+                return fill_leaves(tree, sentence), np.float32(score)
 
-    def parse(self, sentence, verbose=True, use_numpy=False, num_trees=10, root='TOP'):
-        processed_sentence = process_sentence(sentence, self.grammar.w2i)
         if verbose:
-            print('Processed sentence: `{}`'.format(' '.join(processed_sentence)))
+            words = ' '.join(self.grammar.i2w[i] for i in sentence_array)
+            print(f'Processed sentence: `{words}`')
             print('Running CKY...')
-        score, back = self.cky(processed_sentence, use_numpy=use_numpy)
+        score, back = self.cky(
+            sentence_array, use_numpy=use_numpy, beam=beam, threshold=threshold,
+            coarse_threshold=coarse_threshold)
+        if verbose and self.num_pruned:
+            print(f'Pruned {self.num_pruned:,} chart items.')
 
         root_id = self.grammar.n2i[root]
-        score = score[root_id, 0, -1]
+        if score[root_id, -1] == -np.inf and self.num_pruned:
+            if verbose:
+                print('No parse left after pruning, running exhaustive CKY...')
+            num_pruned = self.num_pruned
+            score, back = self.cky(
+                sentence_array, use_numpy=use_numpy, beam=0, threshold=0, coarse_threshold=0)
+            self.num_pruned = num_pruned  # by the pruned pass, which was also run
+        score = score[root_id, -1]
 
         if verbose:
             print('Building tree...')
-        tree = self.build_tree(back, sentence, root=root)
+        if cached:
+            tree = self.build_string(back, [LEAF] * len(sentence), root=root)
+            self.parse_cache.put(namespace, sentence_array, tree, float(score))
+            tree = fill_leaves(tree, sentence)
+        elif as_string:
+            tree = self.build_string(back, sentence, root=root)
+        else:
+            tree = self.build_tree(back, sentence, root=root)
 
         return tree, score
 
     def perplexity(self, sentence):
-        processed_sentence = process_sentence(sentence, self.grammar.w2i)
-
         sent_len = len(sentence)
 
-        sentence_array = np.array(
-            [self.grammar.w2i[word] for word in processed_sentence], dtype=np.int32)
+        sentence_array = self.grammar.process_sentence(sentence)
+        if self.parse_cache is not None:
+            namespace = self.cache_namespace('perplexity')
+            result = self.parse_cache.get(namespace, sentence_array)
+            if result is not None:
+                return np.float64(result[1])
+
+        # the inside pass needs no backpointers
+        score, logprob = self.inside(self.grammar, self.charts, sentence_array)
+
+        perplexity = np.exp(-logprob / sent_len)
+        if self.parse_cache is not None:
+            self.parse_cache.put(namespace, sentence_array, None, float(perplexity))
+        return perplexity
 
-        score = -np.inf * np.ones(
-            (self.grammar.num_nonterminals, sent_len+1, sent_len+1), dtype=np.float32)
+    def cache_namespace(self, kind, *settings):
+        """The key in the parse cache of the results of kind with settings, for this grammar."""
+        return '/'.join([self.fingerprint, kind] + [str(setting) for setting in settings])
 
-        back = -1 * np.ones(
-            (self.grammar.num_nonterminals, sent_len+1, sent_len+1, 3), dtype=np.int32)
+    def marginals(self, sentence):
+        """Posterior probabilities of all chart items, and the sentence logprob.
 
-        # Inside recursion
+        Returns a chart of shape (num_nonterminals, num_cells) that holds at [A, c]
+        the probability that A spans cell c, see cky/chart.py, and all zeros when
+        the sentence has no parse. Unlike the charts of the CKY, the chart is not
+        reused by the next call.
+        """
+        sentence_array = self.grammar.process_sentence(sentence)
+        score, logprob = self.inside_outside(self.grammar, self.charts, sentence_array)
+        if logprob == -np.inf:
+            return np.zeros_like(score), logprob
+        return np.exp(score), logprob
+
+    def inside(self, grammar, charts, sentence_array):
+        """The inside chart under grammar in the score chart of charts, and the sentence logprob."""
+        sent_len = len(sentence_array)
+        score = charts.score(sent_len)
         logprob = _cky.inside(
             sentence_array,
             sent_len,
             score,
-            self.grammar.num_lexical_rules,
-            self.grammar.num_unary_rules,
-            self.grammar.num_binary_rules,
-            self.grammar.num_nonterminals,
-            self.grammar.lexical,
-            self.grammar.unary,
-            self.grammar.binary,
-            self.grammar.top,
-            self.grammar.lexical_prob,
-            self.grammar.unary_prob,
-            self.grammar.binary_prob,
-            self.grammar.top_prob,
+            *charts.live(sent_len),
+            charts.lexical(sent_len),
+            grammar.num_unary_rules,
+            grammar.num_binary_rules,
+            grammar.lexical,
+            grammar.unary,
+            grammar.binary,
+            grammar.top,
+            grammar.lexical_offsets,
+            grammar.binary_offsets,
+            grammar.lexical_logprob,
+            grammar.unary_logprob,
+            grammar.binary_logprob,
+            grammar.top_logprob,
+            self.num_threads
         )
+        return score, logprob
 
-        return np.exp(-logprob / sent_len)
+    def inside_outside(self, grammar, charts, sentence_array):
+        """Log posteriors of all chart items under grammar, and the sentence logprob.
 
-    def cky(self, sentence, use_numpy=False):
-        sent_len = len(sentence)
-        sentence_array = np.array(
-            [self.grammar.w2i[word] for word in sentence], dtype=np.int32)
+        The posteriors are in the score chart of charts.
+        """
+        sent_len = len(sentence_array)
+        score, logprob = self.inside(grammar, charts, sentence_array)
+        if logprob == -np.inf:
+            return score, logprob
+        outside = charts.outside(sent_len)
+        _cky.outside(
+            sentence_array,
+            sent_len,
+            score,
+            outside,
+            charts.lexical(sent_len),
+            charts.unary_outside(sent_len),
+            grammar.num_unary_rules,
+            grammar.num_nonterminals,
+            grammar.lexical,
+            grammar.unary,
+            grammar.binary,
+            grammar.top,
+            grammar.lexical_offsets,
+            grammar.binary_offsets,
+            grammar.lexical_logprob,
+            grammar.unary_logprob,
+            grammar.binary_logprob,
+            grammar.top_logprob,
+        )
+        # the inside chart becomes the posterior chart
+        score += outside
+        score -= logprob
+        return score, logprob
 
-        score = -np.inf * np.ones(
-            (self.grammar.num_nonterminals, sent_len+1, sent_len+1), dtype=np.float32)
+    def cky(
+            self,
+            sentence_array,
+            use_numpy=False,
+            beam=None,
+            threshold=None,
+            coarse_threshold=None
+    ):
+        """Run the CKY on the word ids of a sentence, see PCFG.process_sentence."""
+        beam = self.beam if beam is None else beam
+        threshold = self.threshold if threshold is None else threshold
+        coarse_threshold = self.coarse_threshold if coarse_threshold is None else coarse_threshold
+        sent_len = len(sentence_array)
 
-        back = -1 * np.ones(
-            (self.grammar.num_nonterminals, sent_len+1, sent_len+1, 3), dtype=np.int32)
+        allowed = None
+        if coarse_threshold > 0 and not use_numpy:
+            allowed = self.coarse_mask(sentence_array, coarse_threshold)
+
+        score = self.charts.score(sent_len)
+        back = self.charts.back(sent_len)
 
         if not use_numpy:
-            score, back = _cky.cky(
+            score, back_rule, back_split, self.num_pruned = _cky.cky(
                 sentence_array,
                 sent_len,
                 score,
-                back,
-                self.grammar.num_lexical_rules,
+                *back,
+                *self.charts.live(sent_len),
+                self.charts.lexical(sent_len),
                 self.grammar.num_unary_rules,
                 self.grammar.num_binary_rules,
                 self.grammar.lexical,
                 self.grammar.unary,
                 self.grammar.binary,
                 self.grammar.top,
-                self.grammar.lexical_prob,
-                self.grammar.unary_prob,
-                self.grammar.binary_prob,
-                self.grammar.top_prob
+                self.grammar.lexical_offsets,
+                self.grammar.binary_offsets,
+                self.grammar.lexical_logprob,
+                self.grammar.unary_logprob,
+                self.grammar.binary_logprob,
+                self.grammar.top_logprob,
+                self.num_threads,
+                beam,
+                threshold,
+                allowed,
+                None if allowed is None else self._coarse[1]
             )
-            score, back = np.asarray(score), np.asarray(back)
+            score, back = np.asarray(score), (np.asarray(back_rule), np.asarray(back_split))
 
-        else:
-            print('Warning: using slow NumPy CKY!')
-            score, back = cky_numpy.cky(
+        else:  # exhaustive
+            self.num_pruned = 0
+            score, *back = cky_numpy.cky(
                 sentence_array,
                 score,
-                back,
+                *back,
                 self.grammar.lexical,
                 self.grammar.unary,
                 self.grammar.binary,
-                self.grammar.lexical_prob,
-                self.grammar.unary_prob,
-                self.grammar.binary_prob
+                self.grammar.top,
+                self.grammar.lexical_offsets,
+                self.grammar.lexical_logprob,
+                self.grammar.unary_logprob,
+                self.grammar.binary_logprob,
+                self.grammar.top_logprob
             )
 
         return score, back
 
+    def coarse_mask(self, sentence_array, coarse_threshold):
+        """For each coarse nonterminal and span, whether its posterior is at least coarse_threshold.
+
+        Returns None when the coarse grammar has no parse, so that nothing is pruned.
+        The grammar is projected the first time, also when only a call asks for
+        coarse-to-fine parsing.
+        """
+        if self._coarse is None:
+            coarse, projection = self.grammar.project()
+            charts = ChartArena(coarse.num_nonterminals, self.charts.cell_major)
+            self._coarse = coarse, projection, charts
+        coarse, projection, charts = self._coarse
+        posterior, logprob = self.inside_outside(coarse, charts, sentence_array)
+        if not np.isfinite(logprob):
+            return None
+        return (posterior >= np.log(coarse_threshold)).astype(np.uint8)
+
+    def root_child(self, back, root='TOP'):
+        """The child of the root item in the last cell, raises ValueError when there is no parse."""
+        back_rule, back_split = back  # see _cky.cky
+        root_id = self.grammar.n2i[root]
+        split, rule = back_split[root_id][-1], back_rule[root_id][-1]
+        if split == -3:  # a top rule like TOP -> B
+            return self.grammar.top[rule][1]
+        if split == -2:  # a unary rule like TOP -> Tag, in a sentence of one word
+            return self.grammar.unary[rule][1]
+        # split -1 is also the fill value of the items that were never built, see ChartArena.back
+        raise ValueError(f'The sentence has no parse with root {root}.')
+
     def build_tree(self, back, sentence, root='TOP'):
+        """The binarized nltk.Tree of the backpointers."""
+        back_rule, back_split = back  # see _cky.cky
+        sent_len = len(sentence)
 
-        def recursion(begin, end, A):
-            split, B, C = back[A][begin][end]
-            A = self.grammar.i2n[A]
+        # build the trees bottom-up: an item is expanded when first popped,
+        # and its tree is made when popped again, after the trees of its children
+        B = self.root_child(back, root)
+        stack, trees = [(0, sent_len, B, False)], []
+        while stack:
+            begin, end, A, expanded = stack.pop()
+            c = chart.cell(begin, end, sent_len)
+            split, rule = back_split[A][c], back_rule[A][c]
             if split == -1:  # a unary rule like Tag -> word
-                return Tree(A, [sentence[begin]])
-            if split == -2:  # a unary rule like Nonterminal -> Tag
-                return Tree(A, [recursion(begin, -1, B)])  # B must be a tag so split is -1
-            else:  # a binary rule like A -> B C
-                return Tree(A, [recursion(begin, split, B), recursion(split, end, C)])
+                trees.append(Tree(self.grammar.i2n[A], [sentence[begin]]))
+            elif not expanded:
+                stack.append((begin, end, A, True))
+                if split == -2:  # a unary rule like Nonterminal -> Tag
+                    _, B = self.grammar.unary[rule]
+                    stack.append((begin, end, B, False))
+                else:  # a binary rule like A -> B C
+                    _, B, C = self.grammar.binary[rule]
+                    stack.append((split, end, C, False))
+                    stack.append((begin, split, B, False))
+            else:
+                num_children = 1 if split == -2 else 2
+                children = trees[-num_children:]
+                del trees[-num_children:]
+                trees.append(Tree(self.grammar.i2n[A], children))
 
-        # find out what the the root expands to
-        _, B, _ = back[self.grammar.n2i[root]][0][len(sentence)]  # TOP -> B
-        # build the rest of the binary tree from there
-        tree = recursion(0, len(sentence), B)
         # attach the root to the top of the tree
-        return Tree(root, [tree])
+        return Tree(root, trees)
+
+    def build_string(self, back, sentence, root='TOP'):
+        """The de-binarized tree of the backpointers as a one-line bracket string.
+
+        Gives the same string as build_tree followed by un_chomsky_normal_form and
+        pformat(margin=np.inf), without making the trees.
+        """
+        back_rule, back_split = back  # see _cky.cky
+        sent_len = len(sentence)
+        if self._brackets is None:
+            self._brackets = [
+                bracket_ends(self.grammar.i2n[A]) for A in range(self.grammar.num_nonterminals)]
+
+        B = self.root_child(back, root)
+        # the stack holds items and the strings to write once their subtrees are done
+        pieces, stack = [f'({root} '], [')', (0, sent_len, B)]
+        while stack:
+            item = stack.pop()
+            if isinstance(item, str):
+                pieces.append(item)
+                continue
+            begin, end, A = item
+            c = chart.cell(begin, end, sent_len)
+            split, rule = back_split[A][c], back_rule[A][c]
+            opening, closing = self._brackets[A]
+            pieces.append(opening)
+            stack.append(closing)
+            if split == -1:  # a unary rule like Tag -> word
+                pieces.append(sentence[begin])
+            elif split == -2:  # a unary rule like Nonterminal -> Tag
+                stack.append((begin, end, self.grammar.unary[rule][1]))
+            else:  # a binary rule like A -> B C
+                _, B, C = self.grammar.binary[rule]
+                stack.extend(((split, end, C), ' ', (begin, split, B)))
+        return ''.join(pieces)
 
     def evalb(self, gold, pred):
-        gold = evalb_parser.create_from_bracket_string(gold)
-        pred = evalb_parser.create_from_bracket_string(pred)
-        result = scorer.Scorer().score_trees(gold, pred)
-        prec, recall = result.prec, result.recall
-        fscore = 2 * (prec * recall) / (prec + recall)
-        return prec, recall, fscore
+        score = score_sentence(gold, pred)
+        return score.precision, score.recall, score.fscore
+
+
+def bracket_ends(label, child_char='|', parent_char='^', unary_char='+'):
+    """The strings that open and close the brackets of label in a de-binarized tree.
+
+    Follows nltk's un_chomsky_normal_form: a node with child_char in its label was
+    introduced by the binarization and is spliced into its parent, the parent
+    annotation after parent_char is dropped, and unary_char joins collapsed unaries.
+    """
+    if child_char in label:
+        return '', ''
+    label = label.split(parent_char)[0]
+    labels = label.split(unary_char)
+    return ''.join(f'({label} ' for label in labels), ')' * len(labels)
@@ -1,9 +1,28 @@
+import os
+import hashlib
+import weakref
 from collections import defaultdict
+from multiprocessing import shared_memory
 
 import numpy as np
 from tqdm import tqdm
 
-from utils import TOP
+from utils import TOP, ceil_div, process_word
+
+
+# the numpy arrays of a grammar, see PCFG.share
+ARRAYS = (
+    'lexical', 'unary', 'binary', 'top',
+    'lexical_prob', 'unary_prob', 'binary_prob', 'top_prob',
+    'lexical_logprob', 'unary_logprob', 'binary_logprob', 'top_logprob',
+    'lexical_offsets', 'binary_offsets',
+)
+
+# the most raw tokens whose word id a grammar remembers, see PCFG.word_id
+WORD_CACHE_SIZE = 2**18
+
+# the version of the arrays in a compiled grammar cache, bump it when they change
+CACHE_VERSION = 1
 
 
 class PCFG:
@@ -36,6 +55,122 @@ class PCFG:
         self.binary_prob = binary_prob
         self.top_prob = top_prob
 
+        self._index_lexicals()
+        self._index_binaries()
+
+        # the CKY kernels work in the log domain
+        self.lexical_logprob = log(self.lexical_prob)
+        self.unary_logprob = log(self.unary_prob)
+        self.binary_logprob = log(self.binary_prob)
+        self.top_logprob = log(self.top_prob)
+
+        self._shm, self._layout = None, None  # see share
+        self._word_ids = {}  # see word_id
+
+    def word_id(self, token):
+        """The id of the grammar word of a raw token, after processing and unking.
+
+        The ids are memoized per token, and the memo is emptied when it grows
+        beyond WORD_CACHE_SIZE tokens.
+        """
+        try:
+            return self._word_ids[token]
+        except KeyError:
+            pass
+        if len(self._word_ids) >= WORD_CACHE_SIZE:
+            self._word_ids.clear()
+        word_id = self._word_ids[token] = self.w2i[process_word(token, self.w2i)]
+        return word_id
+
+    def fingerprint(self):
+        """A hash of the rules, probabilities and symbols, equal for equal grammars."""
+        digest = hashlib.sha1()
+        for name in ARRAYS:
+            digest.update(np.ascontiguousarray(getattr(self, name)).tobytes())
+        digest.update(encode_symbols(self.i2n).tobytes())
+        digest.update(encode_symbols(self.i2w).tobytes())
+        return digest.hexdigest()
+
+    def process_sentence(self, sentence):
+        """The word ids of a tokenized sentence, as an int32 array for the CKY."""
+        return np.array([self.word_id(token) for token in sentence], dtype=np.int32)
+
+    def share(self):
+        """Move the grammar arrays and the vocabularies into one shared memory block.
+
+        A shared grammar pickles to the name and layout of the block, and
+        unpickling it attaches to the block without copying the arrays. The
+        block is removed when the grammar that created it is garbage collected.
+        """
+        if self._shm is not None:
+            return
+        arrays = {name: getattr(self, name) for name in ARRAYS}
+        arrays['nonterminals'] = encode_symbols(self.i2n)
+        arrays['words'] = encode_symbols(self.i2w)
+
+        layout, size = [], 0
+        for name, array in arrays.items():
+            layout.append((name, array.dtype.str, array.shape, size))
+            size += ceil_div(array.nbytes, 64) * 64  # keep the arrays aligned
+
+        shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        for name, dtype, shape, offset in layout:
+            np.ndarray(shape, dtype, buffer=shm.buf, offset=offset)[...] = arrays[name]
+        self._attach(shm, layout)
+        weakref.finalize(self, shm.unlink)
+
+    def _attach(self, shm, layout):
+        views = {
+            name: np.ndarray(shape, dtype, buffer=shm.buf, offset=offset)
+            for name, dtype, shape, offset in layout
+        }
+        for name in ARRAYS:
+            setattr(self, name, views[name])
+        self._shm, self._layout = shm, layout
+        return views
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        if self._shm is not None:
+            for name in ARRAYS + ('n2i', 'i2n', 'w2i', 'i2w'):
+                del state[name]
+            state['_shm'] = self._shm.name
+        state['_word_ids'] = {}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self._shm is not None:
+            views = self._attach(shared_memory.SharedMemory(name=self._shm), self._layout)
+            self.i2n = decode_symbols(views['nonterminals'])
+            self.i2w = decode_symbols(views['words'])
+            self.n2i = dict((nt, i) for i, nt in self.i2n.items())
+            self.w2i = dict((word, i) for i, word in self.i2w.items())
+
+    def _index_lexicals(self):
+        """Group the lexical rules by word, CSR-style.
+
+        The tags of word w are at rows lexical_offsets[w]:lexical_offsets[w+1].
+        """
+        order = np.argsort(self.lexical[:, 1], kind='stable')
+        self.lexical = np.ascontiguousarray(self.lexical[order])
+        self.lexical_prob = np.ascontiguousarray(self.lexical_prob[order])
+        counts = np.bincount(self.lexical[:, 1], minlength=self.num_words)
+        self.lexical_offsets = np.zeros(self.num_words + 1, dtype=np.int32)
+        np.cumsum(counts, out=self.lexical_offsets[1:])
+
+    def _index_binaries(self):
+        """Group the binary rules by left child, CSR-style.
+
+        Rules with left child B are at rows binary_offsets[B]:binary_offsets[B+1].
+        """
+        order = np.argsort(self.binary[:, 1], kind='stable')
+        self.binary = np.ascontiguousarray(self.binary[order])
+        self.binary_prob = np.ascontiguousarray(self.binary_prob[order])
+        counts = np.bincount(self.binary[:, 1], minlength=self.num_nonterminals)
+        self.binary_offsets = np.zeros(self.num_nonterminals + 1, dtype=np.int32)
+        np.cumsum(counts, out=self.binary_offsets[1:])
+
     def from_file(path, expand_binaries=False):
         nlines = sum(1 for _ in open(path))
         nonterminals, vocab = set(), set()
@@ -120,6 +255,88 @@ class PCFG:
 
         return PCFG(n2i, i2n, w2i, i2w, lexical, unary, binary, top, lexical_prob, unary_prob, binary_prob, top_prob)
 
+    def from_file_cached(path, expand_binaries=False):
+        """Like from_file, but through a compiled cache saved next to the grammar file.
+
+        The cache is keyed on CACHE_VERSION and the modification time and size of
+        the grammar file, and is rebuilt when either changes. A cache that cannot
+        be read, say one that was cut short, is rebuilt as well.
+        """
+        cache_path = path + ('.expanded.npz' if expand_binaries else '.npz')
+        stat = os.stat(path)
+        stamp = np.array([CACHE_VERSION, stat.st_mtime_ns, stat.st_size], dtype=np.int64)
+        if os.path.exists(cache_path):
+            try:
+                with np.load(cache_path) as data:
+                    fresh = 'stamp' in data and np.array_equal(data['stamp'], stamp)
+                if fresh:
+                    return PCFG.load(cache_path)
+            except Exception as error:
+                print(f'Could not load cached grammar at {cache_path}, rebuilding it: {error}')
+        grammar = PCFG.from_file(path, expand_binaries)
+        try:
+            grammar.save(cache_path, stamp)
+        except OSError as error:
+            print(f'Could not cache grammar at {cache_path}: {error}')
+        return grammar
+
+    def save(self, path, stamp=None):
+        """Save the compiled grammar as an uncompressed npz archive."""
+        arrays = {name: getattr(self, name) for name in ARRAYS}
+        arrays['nonterminals'] = encode_symbols(self.i2n)
+        arrays['words'] = encode_symbols(self.i2w)
+        if stamp is not None:
+            arrays['stamp'] = stamp
+        with open(path, 'wb') as fout:  # np.savez would append .npz to the path
+            np.savez(fout, **arrays)
+
+    def load(path):
+        """Load a grammar saved with save, without recomputing any of its arrays.
+
+        Like the other messages of the grammar, the progress goes to stdout, which
+        main redirects to stderr when the trees go to stdout.
+        """
+        print(f'Loading compiled grammar from {path}...')
+        grammar = PCFG.__new__(PCFG)
+        with np.load(path) as data:
+            for name in ARRAYS:
+                setattr(grammar, name, data[name])
+            grammar.i2n = decode_symbols(data['nonterminals'])
+            grammar.i2w = decode_symbols(data['words'])
+        grammar.n2i = dict((nt, i) for i, nt in grammar.i2n.items())
+        grammar.w2i = dict((word, i) for i, word in grammar.i2w.items())
+        grammar._shm, grammar._layout = None, None
+        grammar._word_ids = {}
+        return grammar
+
+    def project(self, label=None):
+        """Project the grammar onto coarser nonterminals, by default with coarse_label.
+
+        Returns the coarse grammar and an array that maps each nonterminal id
+        to its coarse id. The probability of a coarse rule is the sum of the
+        probabilities of the rules that project onto it, averaged over the
+        nonterminals that project onto its left-hand side.
+        """
+        label = label or coarse_label
+        labels = sorted(set(label(nt) for nt in self.n2i))
+        n2i = dict((nt, i) for i, nt in enumerate(labels))
+        i2n = dict((i, nt) for nt, i in n2i.items())
+
+        projection = np.array(
+            [n2i[label(self.i2n[i])] for i in range(self.num_nonterminals)], dtype=np.int32)
+        weight = 1 / np.bincount(projection)[projection]
+
+        lexical, lexical_prob = project_rules(
+            self.lexical, self.lexical_prob, projection, weight, 1)
+        unary, unary_prob = project_rules(self.unary, self.unary_prob, projection, weight, 2)
+        binary, binary_prob = project_rules(self.binary, self.binary_prob, projection, weight, 3)
+        top, top_prob = project_rules(self.top, self.top_prob, projection, weight, 2)
+
+        coarse = PCFG(
+            n2i, i2n, self.w2i, self.i2w, lexical, unary, binary, top,
+            lexical_prob, unary_prob, binary_prob, top_prob)
+        return coarse, projection
+
     def __len__(self):
         return self.unary.shape[0] + self.binary.shape[0]
 
@@ -216,6 +433,43 @@ class PCFG:
         return [self.top_rule(i) for i in range(self.top.shape[0])]
 
 
+def coarse_label(label):
+    """The base category of a nonterminal from make-cnf.py.
+
+    Parent annotations are dropped (NP^<S> is NP), and the intermediate
+    nodes of binarization become one symbol per category (NP|<DT-NN> is @NP).
+    """
+    base = label.split('|')[0].split('^')[0]
+    return '@' + base if '|' in label else base
+
+
+def project_rules(rules, prob, projection, weight, num_nonterminal_columns):
+    """Project rules with projection and sum the probabilities weighted by their lhs."""
+    columns = slice(0, num_nonterminal_columns)
+    coarse = rules.copy()
+    coarse[:, columns] = projection[rules[:, columns]]
+    coarse, inverse = np.unique(coarse, axis=0, return_inverse=True)
+    coarse_prob = np.zeros(coarse.shape[0], dtype=np.float64)
+    np.add.at(coarse_prob, inverse.ravel(), prob * weight[rules[:, 0]])
+    return coarse.astype(np.int32), coarse_prob.astype(np.float32)
+
+
+def encode_symbols(i2s):
+    """Encode an index-to-symbol dict as newline separated utf-8 bytes."""
+    symbols = '\n'.join(i2s[i] for i in range(len(i2s)))
+    return np.frombuffer(symbols.encode(), dtype=np.uint8)
+
+
+def decode_symbols(array):
+    symbols = bytes(array).decode().split('\n') if array.size else []
+    return dict(enumerate(symbols))
+
+
+def log(prob):
+    """Log-probabilities as float32, computed in double precision."""
+    return np.log(prob.astype(np.float64)).astype(np.float32)
+
+
 def expand_binaries_with_unaries(binary_rules, unary_rules):
     expanded_binary_rules = list(binary_rules)  # all binary rules are already part
     for rule in tqdm(binary_rules):
@@ -1,11 +1,140 @@
+import os
+import sys
 import multiprocessing as mp
+from itertools import islice
 
 import numpy as np
-from nltk import tokenize, Tree
+from nltk import tokenize as nltk_tokenize, Tree
 from tqdm import tqdm
 
 from parser import Parser
-from utils import ceil_div
+
+
+_parser = None  # the parser of a pool worker
+
+
+class ParserPool:
+    """A persistent pool of worker processes that each hold the parser.
+
+    The parser is handed to each worker once, when the pool starts. Its
+    grammar is moved to shared memory first, so that workers that receive
+    the parser pickled (with the spawn or forkserver start methods) attach
+    to one copy of the rule arrays instead of each getting their own.
+    """
+
+    def __init__(self, parser, processes=None):
+        parser.grammar.share()
+        self.processes = processes or mp.cpu_count()
+        self.pool = mp.Pool(self.processes, initializer=init_worker, initargs=(parser,))
+
+    def imap(self, func, items, key=len, window=None):
+        """Yield func(parser, item) for each item, in input order.
+
+        Items are scheduled one at a time, largest key first, so that the
+        long sentences do not all end up at the end of one worker's queue.
+        With window, the items are read and scheduled window items at a time,
+        so that items can be a stream of which only one window is in memory.
+        """
+        items = iter(items)
+        while True:
+            chunk = list(islice(items, window))
+            if not chunk:
+                return
+            yield from self._imap_chunk(func, chunk, key)
+
+    def _imap_chunk(self, func, items, key):
+        order = sorted(range(len(items)), key=lambda i: key(items[i]), reverse=True)
+        tasks = ((func, i, items[i]) for i in order)
+        done, next_index = {}, 0
+        for i, result in self.pool.imap_unordered(work, tasks):
+            done[i] = result
+            while next_index in done:  # stream back in input order
+                yield done.pop(next_index)
+                next_index += 1
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is not None:  # do not wait for the work in progress
+            self.pool.terminate()
+        self.close()
+
+
+def init_worker(parser):
+    global _parser
+    _parser = parser
+
+
+def work(task):
+    func, i, item = task
+    return i, func(_parser, item)
+
+
+def parse_tree(parser, sentence):
+    """Parse a sentence, returns the de-binarized tree as a one-line bracket string,
+    whether the sentence failed to parse, and the number of chart items pruned.
+
+    A sentence without a parse gets a flat tree, see flat_tree, so that a bulk run
+    goes on and its output keeps one tree for each line of the input.
+    """
+    try:
+        tree, score = parser.parse(sentence, verbose=False, as_string=True)
+    except ValueError:
+        return flat_tree(sentence), True, parser.num_pruned
+    return tree, False, parser.num_pruned
+
+
+def flat_tree(sentence, root='TOP', label='X'):
+    """A tree with each word under label, directly under the root."""
+    return '({} {})'.format(root, ' '.join(f'({label} {word})' for word in sentence))
+
+
+class ParseCounts:
+    """Counts over the sentences of a bulk run, see count."""
+
+    def __init__(self):
+        self.failed = 0
+        self.pruned = 0  # chart items
+
+    def add(self, failed, num_pruned):
+        self.failed += failed
+        self.pruned += num_pruned
+
+    def report(self):
+        if self.failed > 0:
+            print(f'Failed to parse {self.failed} sentences, wrote a flat tree for each.')
+        if self.pruned > 0:
+            print(f'Pruned {self.pruned:,} chart items.')
+
+
+def count(results, counts=None):
+    """Yield the tree of each result of parse_tree, and add the rest of it to counts."""
+    for tree, *result in results:
+        if counts is not None:
+            counts.add(*result)
+        yield tree
+
+
+def read_sentences(infile, max_lines=None, tokenize=False, skip=0):
+    """Yield the tokens of each line of infile, read from stdin when infile is '-'.
+
+    The first skip lines are skipped, and they count towards max_lines.
+    """
+    fin = sys.stdin if infile == '-' else open(infile)
+    try:
+        for line in islice(fin, skip, max_lines):
+            if tokenize:
+                yield nltk_tokenize.word_tokenize(line.strip())
+            else:
+                yield line.strip().split()
+    finally:
+        if fin is not sys.stdin:
+            fin.close()
 
 
 def predict_from_trees(parser, infile):
@@ -19,68 +148,77 @@ def predict_from_trees(parser, infile):
         yield gold, pred, prec, recall, fscore
 
 
-def predict_from_file(parser, infile, max_lines=None, tokenize=False):
-    with open(infile) as fin:
-        if tokenize:
-            sentences = [tokenize.word_tokenize(line.strip()) for line in fin.readlines()]
-        else:
-            sentences = [line.strip().split() for line in fin.readlines()]
-        sentences = sentences if max_lines == None else sentences[:max_lines]
-    predicted = []
-    failed = 0
+def predict_from_file(parser, infile, max_lines=None, tokenize=False, skip=0, counts=None):
+    """Yield the tree of each sentence of infile as soon as it is parsed, see read_sentences.
+
+    With counts, a ParseCounts, count the sentences that failed to parse and the
+    chart items that were pruned.
+    """
+    sentences = tqdm(read_sentences(infile, max_lines, tokenize, skip), initial=skip)
+    yield from count((parse_tree(parser, sentence) for sentence in sentences), counts)
+
+
+def predict_from_file_parallel(
+        parser, infile, max_lines=None, tokenize=False, skip=0, counts=None, processes=None,
+        window=1000):
+    """Like predict_from_file, parsing window sentences at a time in a ParserPool."""
+    with ParserPool(parser, processes) as pool:
+        print(f'Predicting in parallel with {pool.processes} processes...')
+        sentences = read_sentences(infile, max_lines, tokenize, skip)
+        results = tqdm(pool.imap(parse_tree, sentences, window=window), initial=skip)
+        yield from count(results, counts)
+
+
+class Checkpoint:
+    """A sidecar file that records how much of an output file of trees is complete.
+
+    It holds the number of trees written and the size of the output file after
+    the last of them, so that a resumed run can skip the sentences of these trees
+    and cut off a tree that was only partly written.
+    """
+
+    def __init__(self, outpath, every=100):
+        self.path = outpath + '.checkpoint'
+        self.every = every  # trees between checkpoints
+
+    def load(self):
+        """The number of trees and the size of the output file, (0, 0) without a checkpoint."""
+        if not os.path.exists(self.path):
+            return 0, 0
+        with open(self.path) as fin:
+            num_trees, size = map(int, fin.read().split())
+        return num_trees, size
+
+    def save(self, num_trees, size):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as fout:
+            print(num_trees, size, file=fout)
+        os.replace(tmp_path, self.path)  # atomic, so a crash leaves the old checkpoint
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def write_trees(trees, fout, checkpoint=None, num_trees=0):
+    """Write each tree on a line of fout as soon as it comes, return the number of trees in fout.
+
+    With checkpoint, commit the trees every checkpoint.every trees and when writing
+    stops, also with an exception. num_trees is the number of trees already in fout.
+    """
+    size = fout.tell() if checkpoint else 0
     try:
-        for i, sentence in enumerate(tqdm(sentences)):
-            tree, score = parser.parse(sentence, verbose=False)
-            tree.un_chomsky_normal_form()
-            tree = tree.pformat(margin=np.inf)
-            predicted.append(tree)
-    except KeyboardInterrupt:
-        print(f'Prediction interrupted at sentence {i}.')
-    if failed > 0:
-        print(f'Failed to parse {failed} sentences.')
-    return predicted
-
-
-def predict_from_file_parallel(parser, infile, max_lines=None, tokenize=False):
-    size = mp.cpu_count()
-    print(f'Predicting in parallel with {size} processes...')
-
-    def worker(parser, sentences, rank, return_dict, failed_dict):
-        predicted = []
-        failed = 0
-        if rank == 0:
-            sentences = tqdm(sentences)
-        for sentence in sentences:
-            tree, score = parser.parse(sentence, verbose=False)
-            tree.un_chomsky_normal_form()
-            tree = tree.pformat(margin=np.inf)
-            predicted.append(tree)
-        return_dict[rank] = predicted
-        failed_dict[rank] = failed
-
-    # Read sentences and partition them, to be distributed among processes.
-    with open(infile) as fin:
-        if tokenize:
-            sentences = [tokenize.word_tokenize(line.strip()) for line in fin.readlines()]
-        else:
-            sentences = [line.strip().split() for line in fin.readlines()]
-        sentences = sentences if max_lines == None else sentences[:max_lines]
-    chunk_size = ceil_div(len(sentences), size)
-    partitioned = [sentences[i:i+chunk_size] for i in range(0, len(sentences), chunk_size)]  # TODO: we lose some sentences here...
-
-    # Spawn processes.
-    manager = mp.Manager()
-    return_dict = manager.dict()  # To return trees.
-    failed_dict = manager.dict()  # To return number of failed parses.
-    processes = []
-    for rank in range(size):
-        p = mp.Process(target=worker, args=(parser, partitioned[rank], rank, return_dict, failed_dict))
-        p.start()
-        processes.append(p)
-    for p in processes:
-        p.join()
-    trees = sum([return_dict[rank] for rank in range(size)], [])
-    failed = sum([failed_dict[rank] for rank in range(size)])
-    if failed > 0:
-        print(f'Failed to parse {failed} sentences.')
-    return trees
+        for tree in trees:
+            print(tree, file=fout, flush=True)
+            num_trees += 1
+            if checkpoint:
+                size = fout.tell()
+                if num_trees % checkpoint.every == 0:
+                    os.fsync(fout.fileno())
+                    checkpoint.save(num_trees, size)
+    finally:
+        if checkpoint:
+            fout.flush()
+            os.fsync(fout.fileno())
+            checkpoint.save(num_trees, size)
+    return num_trees
@@ -1,12 +1,13 @@
 """Evaluate accuracy on the syneval dataset."""
 import os
 from collections import Counter
-import multiprocessing as mp
+from contextlib import nullcontext
+from functools import partial
 
 import numpy as np
 from tqdm import tqdm
 
-from utils import process_sentence, ceil_div
+from predict import ParserPool
 
 
 ALL = [
@@ -56,7 +57,11 @@ def syneval(parser, indir, outpath, parallel=False, short=False, add_period=True
 
     files = SHORT if short else ALL
 
-    with open(outpath, 'w') as outfile:
+    # the pool is shared by all the files
+    with ParserPool(parser) if parallel else nullcontext() as pool, open(outpath, 'w') as outfile:
+        if parallel:
+            print(f'Predicting in parallel with {pool.processes} processes...')
+
         print('\t'.join((
                 'name', 'index', 'pos-perplexity', 'neg-perplexity',
                 'correct', 'pos-sentence-processed', 'neg-sentence-processed')),
@@ -85,90 +90,44 @@ def syneval(parser, indir, outpath, parallel=False, short=False, add_period=True
 
             assert len(pos_sents) == len(neg_sents)
 
+            pairs = list(zip(pos_sents, neg_sents))
             if parallel:
-                size = mp.cpu_count()
-                print(f'Predicting in parallel with {size} processes...')
-
-                chunk_size = ceil_div(len(pos_sents), size)
-                pos_parts = [pos_sents[i:i+chunk_size] for i in range(0, len(pos_sents), chunk_size)]
-                neg_parts = [neg_sents[i:i+chunk_size] for i in range(0, len(neg_sents), chunk_size)]
-
-                # spawn processes
-                manager = mp.Manager()
-                return_dict = manager.dict()
-                processes = []
-                for rank in range(size):
-                    p = mp.Process(
-                        target=worker, args=(parser, rank, pos_parts[rank], neg_parts[rank], fname, return_dict))
-                    p.start()
-                    processes.append(p)
-                for p in processes:
-                    p.join()
-
-                results = sum([return_dict[rank][0] for rank in range(size)], [])  # merge all results
-                num_correct = sum([return_dict[rank][1] for rank in range(size)])  # sum number of correct results
-
+                perplexities = pool.imap(pair_perplexity, pairs, key=lambda pair: len(pair[0]))
             else:
-                results = []
-                num_correct = 0
-
-                for i, (pos, neg) in enumerate(tqdm(list(zip(pos_sents, neg_sents)))):
-
-                    pos_pp = parser.perplexity(pos)
-                    neg_pp = parser.perplexity(neg)
-                    correct = pos_pp < neg_pp
-                    num_correct += correct
-
-                    # see which words are unked during prediction
-                    pos = process_sentence(pos, parser.grammar.w2i)
-                    neg = process_sentence(neg, parser.grammar.w2i)
-
-                    result =  (
-                        fname,
-                        str(i),
-                        str(round(pos_pp, 2)),
-                        str(round(neg_pp, 2)),
-                        str(int(correct)),
-                        ' '.join(pos),
-                        ' '.join(neg)
-                    )
-                    results.append(result)
+                perplexities = map(partial(pair_perplexity, parser), pairs)
 
-            for result in results:
-                print('\t'.join(result), file=outfile)
+            results = []
+            num_correct = 0
 
-            print(f'{fname}: {num_correct}/{len(pos_sents)} = {num_correct / len(pos_sents):.2%} correct', '\n')
+            scored = tqdm(zip(pairs, perplexities), total=len(pairs))
+            for i, ((pos, neg), (pos_pp, neg_pp)) in enumerate(scored):
 
+                correct = pos_pp < neg_pp
+                num_correct += correct
 
-def worker(parser, rank, pos_sents, neg_sents, name, return_dict):
-    """Parallel worker."""
-    results = []
-    num_correct = 0
+                # see which words are unked during prediction
+                pos = [parser.grammar.i2w[i] for i in parser.grammar.process_sentence(pos)]
+                neg = [parser.grammar.i2w[i] for i in parser.grammar.process_sentence(neg)]
 
-    sentences = list(zip(pos_sents, neg_sents))
-    if rank == 0:
-        sentences = tqdm(list(zip(pos_sents, neg_sents)))
+                result =  (
+                    fname,
+                    str(i),
+                    str(round(pos_pp, 2)),
+                    str(round(neg_pp, 2)),
+                    str(int(correct)),
+                    ' '.join(pos),
+                    ' '.join(neg)
+                )
+                results.append(result)
 
-    for i, (pos, neg) in enumerate(sentences):
-
-        pos_pp = parser.perplexity(pos)
-        neg_pp = parser.perplexity(neg)
-        correct = pos_pp < neg_pp
-        num_correct += correct
+            for result in results:
+                print('\t'.join(result), file=outfile)
 
-        # see which words are unked during prediction
-        pos = process_sentence(pos, parser.grammar.w2i)
-        neg = process_sentence(neg, parser.grammar.w2i)
+            accuracy = num_correct / len(pos_sents)
+            print(f'{fname}: {num_correct}/{len(pos_sents)} = {accuracy:.2%} correct', '\n')
 
-        result =  (
-            name,
-            str(i),
-            str(round(pos_pp, 2)),
-            str(round(neg_pp, 2)),
-            str(int(correct)),
-            ' '.join(pos),
-            ' '.join(neg)
-        )
-        results.append(result)
 
-    return_dict[rank] = (results, num_correct)
+def pair_perplexity(parser, pair):
+    """Perplexities of a (positive, negative) pair of sentences."""
+    pos, neg = pair
+    return parser.perplexity(pos), parser.perplexity(neg)
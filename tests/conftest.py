@@ -0,0 +1,26 @@
+import pytest
+
+from parser import Parser
+
+
+GRAMMAR = """\
+TOP S 0.6
+TOP NN 0.4
+S NP VP 0.7
+S NN 0.3
+NP DT NN 1.0
+VP VBZ 0.6
+VP VBZ NP 0.4
+NN [dog] 0.5
+NN [cat] 0.5
+DT [the] 1.0
+VBZ [barks] 0.5
+VBZ [sees] 0.5
+"""
+
+
+@pytest.fixture
+def parser(tmp_path):
+    path = tmp_path / 'tiny.grammar'
+    path.write_text(GRAMMAR)
+    return Parser(str(path), cache=False)
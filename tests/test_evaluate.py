@@ -0,0 +1,122 @@
+import pytest
+
+from evaluate import Evalb, score_sentence
+
+
+def counts(gold, pred):
+    score = score_sentence(gold, pred)
+    return score.gold, score.test, score.match
+
+
+def test_identical():
+    tree = '(TOP (S (NP (DT the) (NN dog)) (VP (VBZ barks))))'
+    score = score_sentence(tree, tree)
+    # S, NP and VP, without TOP and the tags
+    assert (score.gold, score.test, score.match) == (3, 3, 3)
+    assert (score.words, score.tags, score.crossing, score.error) == (3, 3, 0, False)
+    assert score.fscore == 1
+
+
+def test_punctuation_deleted():
+    gold = '(TOP (S (NP (NNP Mary)) (, ,) (VP (VBZ walks)) (. .)))'
+    pred = '(TOP (S (NP (NNP Mary) (, ,)) (VP (VBZ walks) (. .))))'
+    assert counts(gold, pred) == (3, 3, 3)
+    score = score_sentence(gold, pred)
+    assert (score.length, score.words, score.tags) == (4, 2, 2)
+
+
+def test_mistagged_punctuation():
+    # the gold tags decide which words are deleted
+    gold = '(TOP (S (NP (NNP Mary)) (VP (VBZ walks)) (. .)))'
+    pred = '(TOP (S (NP (NNP Mary)) (VP (VBZ walks) (NN .))))'
+    assert counts(gold, pred) == (3, 3, 3)
+    assert score_sentence(gold, pred).tags == 2
+
+
+def test_function_tags_and_traces():
+    gold = '( (S (NP-SBJ (-NONE- *)) (NP-TMP=1 (NN today)) (VP (VBD left))) )'
+    pred = '(TOP (S (NP (NN today)) (VP (VBD left))))'
+    score = score_sentence(gold, pred)
+    # the NP-SBJ over only a trace is deleted, and the trace is not counted in the length
+    assert (score.gold, score.test, score.match) == (3, 3, 3)
+    assert (score.length, score.words, score.error) == (2, 2, False)
+
+
+def test_equal_labels():
+    gold = '(TOP (VP (VB give) (PRT (RP up))))'
+    pred = '(TOP (VP (VB give) (ADVP (RP up))))'
+    assert counts(gold, pred) == (2, 2, 2)
+
+
+def test_duplicate_brackets():
+    gold = '(TOP (NP (NP (NN dog))))'
+    pred = '(TOP (NP (NN dog)))'
+    score = score_sentence(gold, pred)
+    assert (score.gold, score.test, score.match) == (2, 1, 1)
+    assert (score.precision, score.recall) == (1, 0.5)
+    # and the other way around
+    assert counts(pred, gold) == (1, 2, 1)
+
+
+def test_crossing():
+    gold = '(TOP (S (NP (DT the) (NN dog)) (VP (VBZ barks))))'
+    pred = '(TOP (S (DT the) (VP (NN dog) (VBZ barks))))'
+    score = score_sentence(gold, pred)
+    assert (score.gold, score.test, score.match, score.crossing) == (3, 2, 1, 1)
+
+
+def test_word_mismatch():
+    gold = '(TOP (S (NP (NN dog)) (VP (VBZ barks))))'
+    pred = '(TOP (S (NP (NN cat)) (VP (VBZ barks))))'
+    assert score_sentence(gold, pred).error
+    assert score_sentence(gold, '(TOP (S (NP (NN dog))))').error
+
+
+def test_totals():
+    evalb = Evalb(cutoff=2)
+    evalb.add(score_sentence(
+        '(TOP (S (NP (DT the) (NN dog)) (VP (VBZ barks))))',
+        '(TOP (S (DT the) (VP (NN dog) (VBZ barks))))'))
+    evalb.add(score_sentence(
+        '(TOP (S (NP (NN dog)) (VP (VBZ barks))))',
+        '(TOP (S (NP (NN dog)) (VP (VBZ barks))))'))
+    evalb.add(score_sentence(
+        '(TOP (S (NP (NN dog)) (VP (VBZ barks))))',
+        '(TOP (S (NP (NN cat)) (VP (VBZ barks))))'))
+    totals = evalb.all
+    assert (totals.sentences, totals.errors, totals.valid) == (3, 1, 2)
+    assert (totals.gold, totals.test, totals.match) == (6, 5, 4)
+    assert totals.recall == pytest.approx(100 * 4 / 6)
+    assert totals.precision == pytest.approx(100 * 4 / 5)
+    assert (totals.complete, totals.crossing, totals.no_crossing) == (1, 1, 1)
+    assert (totals.words, totals.tags) == (5, 5)
+    # only the two sentences of two words are at most the cutoff
+    assert (evalb.short.sentences, evalb.short.match) == (2, 3)
+    assert 'Bracketing FMeasure       =  72.73' in evalb.summary()
+
+
+TREES = [
+    '(TOP (S (NP (DT the) (NN dog)) (VP (VBZ barks))))',
+    '(TOP (S (NP (NN dog)) (VP (VBZ barks))))',
+    '(TOP (S (NP (NN cat)) (VP (VBZ sees) (NP (NN dog)))))',
+]
+
+
+@pytest.mark.parametrize('num_gold', [1, 3, 5])
+def test_scored_lengths(tmp_path, num_gold):
+    gold_path = tmp_path / 'gold.trees'
+    gold_path.write_text(''.join(tree + '\n' for tree in (TREES * 2)[:num_gold]))
+    evalb = Evalb()
+    # every tree comes through, also when the gold trees run out
+    assert list(evalb.scored(iter(TREES), str(gold_path))) == TREES
+    assert evalb.all.sentences == max(num_gold, len(TREES))
+    assert evalb.all.valid == min(num_gold, len(TREES))
+    assert evalb.all.errors == abs(num_gold - len(TREES))
+
+
+def test_scored_max_lines(tmp_path):
+    gold_path = tmp_path / 'gold.trees'
+    gold_path.write_text(''.join(tree + '\n' for tree in TREES))
+    evalb = Evalb()
+    assert list(evalb.scored(iter(TREES[1:2]), str(gold_path), skip=1, max_lines=2)) == TREES[1:2]
+    assert (evalb.all.sentences, evalb.all.errors, evalb.all.match) == (1, 0, 3)
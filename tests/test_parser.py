@@ -0,0 +1,78 @@
+import numpy as np
+import pytest
+
+from conftest import GRAMMAR
+from parser import Parser
+from pcfg import CACHE_VERSION
+
+
+def test_one_word(parser):
+    # TOP -> NN is both a top rule and a unary rule, and wins over TOP -> S -> NN
+    tree, score = parser.parse(['dog'], verbose=False)
+    assert str(tree) == '(TOP (NN dog))'
+    assert np.isclose(score, np.log(0.4 * 0.5))
+    tree, score = parser.parse(['dog'], verbose=False, as_string=True)
+    assert tree == '(TOP (NN dog))'
+
+
+def test_sentence(parser):
+    tree, score = parser.parse('the dog sees the cat'.split(), verbose=False, as_string=True)
+    assert tree == '(TOP (S (NP (DT the) (NN dog)) (VP (VBZ sees) (NP (DT the) (NN cat)))))'
+    assert np.isclose(score, np.log(0.6 * 0.7 * 0.5 * 0.4 * 0.5 * 0.5))
+
+
+def test_no_parse(parser):
+    parser.parse('the dog barks'.split(), verbose=False)  # leaves rules in the charts
+    with pytest.raises(ValueError, match='no parse'):
+        parser.parse(['the'], verbose=False)
+    with pytest.raises(ValueError, match='no parse'):
+        parser.parse(['the'], verbose=False, as_string=True)
+
+
+def test_coarse_threshold_per_call(parser):
+    sentence = 'the dog barks'.split()
+    assert parser.parse(sentence, verbose=False, coarse_threshold=1e-3, as_string=True) == \
+        parser.parse(sentence, verbose=False, as_string=True)
+
+
+@pytest.mark.parametrize('sentence', ['dog', 'the dog barks', 'the dog sees the cat'])
+def test_numpy_cky(parser, sentence):
+    sentence = sentence.split()
+    tree, score = parser.parse(sentence, verbose=False, as_string=True)
+    numpy_tree, numpy_score = parser.parse(sentence, verbose=False, as_string=True, use_numpy=True)
+    assert numpy_tree == tree
+    assert np.isclose(numpy_score, score)
+
+
+@pytest.mark.parametrize('sentence', ['dog', 'the dog barks', 'the dog sees the cat'])
+def test_posteriors(parser, sentence):
+    sentence = sentence.split()
+    posterior, logprob = parser.marginals(sentence)
+    assert np.isfinite(logprob)
+    assert np.all(posterior <= 1 + 1e-5)
+    assert np.isclose(posterior[parser.grammar.n2i['TOP'], -1], 1)
+    # each word has exactly one tag
+    tags = [parser.grammar.n2i[tag] for tag in ('NN', 'DT', 'VBZ')]
+    assert np.allclose(posterior[tags, :len(sentence)].sum(axis=0), 1, atol=1e-5)
+
+
+def test_one_word_posteriors(parser):
+    posterior, logprob = parser.marginals(['dog'])
+    n2i = parser.grammar.n2i
+    assert np.isclose(logprob, np.log(0.4 * 0.5 + 0.6 * 0.3 * 0.5))
+    assert np.isclose(posterior[n2i['NN'], 0], 1)
+    assert np.isclose(posterior[n2i['S'], 0], 0.09 / 0.29)
+
+
+def test_grammar_cache(tmp_path):
+    path = tmp_path / 'tiny.grammar'
+    path.write_text(GRAMMAR)
+    cache_path = tmp_path / 'tiny.grammar.npz'
+    # a cache that was cut short is rebuilt, and then loaded
+    for cache in (b'PK\x03\x04', None):
+        if cache is not None:
+            cache_path.write_bytes(cache)
+        parser = Parser(str(path))
+        assert parser.parse(['dog'], verbose=False, as_string=True)[0] == '(TOP (NN dog))'
+        with np.load(cache_path) as data:
+            assert data['stamp'][0] == CACHE_VERSION
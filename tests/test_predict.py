@@ -0,0 +1,24 @@
+from predict import ParseCounts, predict_from_file, predict_from_file_parallel
+
+
+def test_no_parse_keeps_going(parser, tmp_path):
+    infile = tmp_path / 'sentences.tokens'
+    infile.write_text('the dog barks\nthe\ndog\n')
+    for predict in (predict_from_file, predict_from_file_parallel):
+        counts = ParseCounts()
+        trees = list(predict(parser, str(infile), counts=counts))
+        assert trees == [
+            '(TOP (S (NP (DT the) (NN dog)) (VP (VBZ barks))))',
+            '(TOP (X the))',
+            '(TOP (NN dog))',
+        ]
+        assert (counts.failed, counts.pruned) == (1, 0)
+
+
+def test_pruned_counts(parser, tmp_path):
+    infile = tmp_path / 'sentences.tokens'
+    infile.write_text('the dog sees the cat\nthe dog barks\n')
+    parser.beam = 1
+    counts = ParseCounts()
+    list(predict_from_file(parser, str(infile), counts=counts))
+    assert counts.pruned > 0
@@ -20,11 +20,9 @@ GOLD = '(TOP (S (NP (DT The) (NN bill)) (VP (VBZ intends) (S (VP (TO to) (VP ' +
        '(NN authorization)))))) (. .)))'
 
 
-def process_sentence(sentence, vocab):
-    assert isinstance(sentence, list)
-    sentence = [process(word.lower()) for word in sentence]
-    sentence = [word if word in vocab else unkify(word, vocab) for word in sentence]
-    return sentence
+def process_word(word, vocab):
+    word = process(word.lower())
+    return word if word in vocab else unkify(word, vocab)
 
 
 def show(path):